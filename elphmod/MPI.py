@@ -3,8 +3,10 @@
 # Copyright (C) 2021 elphmod Developers
 # This program is free software under the terms of the GNU GPLv3 or later.
 
-import sys
 import numpy as np
+import os
+import sys
+import threading
 
 try:
     from mpi4py import MPI
@@ -36,6 +38,9 @@ except ImportError:
         def allgather(self, send):
             return [send]
 
+        def gather(self, send):
+            return [send]
+
         def Reduce(self, send, recv):
             recv[...] = send
 
@@ -46,7 +51,10 @@ except ImportError:
             return send
 
         def Scatterv(self, send, recv):
-            recv[...] = send[0]
+            if isinstance(recv, tuple):
+                recv = recv[0]
+
+            recv[...] = np.reshape(send[0], recv.shape)
 
         def Split(self, color, key=None):
             return self
@@ -54,15 +62,419 @@ except ImportError:
         def Split_type(self, color, key=None):
             return self
 
+    class Datatype(object):
+        """Contiguous datatype, measured in elements of the buffer arrays."""
+
+        def __init__(self, count=1):
+            self.count = count
+
+        def Create_contiguous(self, count):
+            return Datatype(self.count * count)
+
+        def Commit(self):
+            return self
+
+        def Free(self):
+            pass
+
     class Interface(object):
         def __init__(self):
             self.COMM_WORLD = Communicator()
+            self.COMM_SELF = self.COMM_WORLD
             self.UNDEFINED = 0
             self.COMM_TYPE_SHARED = self.UNDEFINED
+            self.UNSIGNED_CHAR = Datatype()
+
+    class PoolCommunicator(object):
+        """Communicator between forked processes on a single machine.
+
+        Messages are exchanged via one :class:`multiprocessing.Queue` per
+        process. Collective operations are implemented on top of point-to-point
+        messages tagged with the group and a counter of collective calls. The
+        processes are forked when a communicator is used for the first time.
+        """
+        def __init__(self, pool, ranks, context):
+            self.pool = pool
+            self.members = ranks # None for current process only
+            self.context = context
+
+            self.calls = 0
+
+            self.sent = {}
+            self.received = {}
+
+        @property
+        def ranks(self):
+            self.pool.start()
+
+            return [self.pool.rank] if self.members is None else self.members
+
+        @property
+        def rank(self):
+            return self.ranks.index(self.pool.rank)
+
+        @property
+        def size(self):
+            return len(self.ranks)
+
+        def send(self, dest, data, tag=None):
+            self.pool.queues[self.ranks[dest]].put((self.context,
+                self.calls if tag is None else tag, self.rank, data))
+
+        def recv(self, source, tag=None):
+            tag = (self.context, self.calls if tag is None else tag, source)
+
+            while tag not in self.pool.mailbox:
+                message = self.pool.receive()
+                self.pool.mailbox[message[:3]] = message[3]
+
+            return self.pool.mailbox.pop(tag)
+
+        def Send(self, data, dest, tag=0):
+            count = self.sent.get((dest, tag), 0)
+            self.sent[dest, tag] = count + 1
+
+            self.send(dest, np.array(data), ('p2p', tag, count))
+
+        def Recv(self, data, source, tag=0):
+            count = self.received.get((source, tag), 0)
+            self.received[source, tag] = count + 1
+
+            data[...] = np.reshape(self.recv(source, ('p2p', tag, count)),
+                data.shape)
+
+        def gather(self, send, root=0):
+            self.calls += 1
+
+            if self.rank != root:
+                self.send(root, send)
+                return None
+
+            return [send if rank == root else self.recv(rank)
+                for rank in range(self.size)]
+
+        def bcast(self, data, root=0):
+            self.calls += 1
+
+            if self.rank != root:
+                return self.recv(root)
+
+            for rank in range(self.size):
+                if rank != root:
+                    self.send(rank, data)
+
+            return data
+
+        def allgather(self, send):
+            return self.bcast(self.gather(send))
+
+        def allreduce(self, send):
+            return sum(self.allgather(send))
+
+        def barrier(self):
+            self.allgather(None)
+
+        def Barrier(self):
+            self.barrier()
+
+        def Bcast(self, data, root=0):
+            data[...] = self.bcast(data if self.rank == root else None, root)
+
+        def Gatherv(self, send, recv, root=0):
+            parts = self.gather(np.ravel(send), root)
+
+            if self.rank == root:
+                recv[0].reshape(-1)[...] = np.concatenate(parts)
+
+        def Allgatherv(self, send, recv):
+            recv[0].reshape(-1)[...] = np.concatenate(
+                self.allgather(np.ravel(send)))
+
+        def Reduce(self, send, recv, root=0):
+            parts = self.gather(send, root)
+
+            if self.rank == root:
+                recv[...] = sum(parts)
+
+        def Allreduce(self, send, recv):
+            recv[...] = self.allreduce(send)
+
+        def Scatterv(self, send, recv, root=0):
+            self.calls += 1
+
+            if isinstance(recv, tuple):
+                recv = recv[0]
+
+            if self.rank != root:
+                recv[...] = self.recv(root).reshape(recv.shape)
+                return
+
+            data, counts = send[:2]
+
+            if len(send) > 2: # counts in units of derived datatype
+                counts = np.asarray(counts) * send[2].count
+
+            parts = np.split(np.ravel(data), np.cumsum(counts)[:-1])
+
+            for rank in range(self.size):
+                if rank != root:
+                    self.send(rank, parts[rank])
+
+            recv[...] = parts[root].reshape(recv.shape)
+
+        def Split(self, color, key=0):
+            members = self.allgather((color, key, self.pool.rank))
+
+            ranks = [rank for color_, key_, rank in sorted(members)
+                if color_ == color]
+
+            return PoolCommunicator(self.pool, ranks,
+                self.context + ((self.calls, color),))
+
+        def Split_type(self, split_type, key=0):
+            return self.Split(0, key) # all processes are on the same machine
+
+    class Window(object):
+        """Memory shared among forked processes via a memory-mapped file.
+
+        Only the one-sided operations used within elphmod are provided.
+        """
+        def __init__(self, size, disp_unit=1, comm=None):
+            import mmap
+            import tempfile
+
+            self.comm = comm
+            self.disp_unit = disp_unit
+
+            self.offsets = np.cumsum([0] + comm.allgather(size))
+
+            size = max(self.offsets[-1], 1)
+
+            if comm.rank == 0:
+                descriptor, name = tempfile.mkstemp(prefix='elphmod_',
+                    dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+                os.ftruncate(descriptor, size)
+
+                comm.bcast(name)
+            else:
+                name = comm.bcast(None)
+
+                descriptor = os.open(name, os.O_RDWR)
+
+            self.memory = mmap.mmap(descriptor, size)
+
+            os.close(descriptor)
+
+            comm.barrier()
+
+            if comm.rank == 0:
+                os.unlink(name) # memory is released when all have unmapped it
+
+        @classmethod
+        def Allocate(cls, size, disp_unit=1, info=None, comm=None):
+            return cls(size, disp_unit, comm)
+
+        @classmethod
+        def Allocate_shared(cls, size, disp_unit=1, info=None, comm=None):
+            return cls(size, disp_unit, comm)
+
+        @classmethod
+        def Create(cls, memory, disp_unit=1, info=None, comm=None):
+            memory = np.asarray(memory)
+
+            window = cls(memory.nbytes, disp_unit, comm)
+
+            window.Shared_query(comm.rank)[0][:] = memory.tobytes()
+
+            comm.barrier()
+
+            return window
+
+        def Shared_query(self, rank):
+            return (memoryview(self.memory)[
+                self.offsets[rank]:self.offsets[rank + 1]], self.disp_unit)
+
+        def Lock(self, rank, lock_type=None):
+            self.comm.pool.lock.acquire()
+
+        def Unlock(self, rank):
+            self.comm.pool.lock.release()
+
+        def target(self, origin, rank, disp=0):
+            return np.ndarray(origin.shape, dtype=origin.dtype,
+                buffer=self.Shared_query(rank)[0], offset=disp * self.disp_unit)
+
+        def Put(self, origin, target_rank, target=None):
+            self.target(origin, target_rank, target or 0)[...] = origin
+
+        def Fetch_and_op(self, origin, result, target_rank, target_disp=0,
+                op=None):
+            target = self.target(origin, target_rank, target_disp)
+
+            result[...] = target
+            target += origin
+
+        def Free(self):
+            self.comm.barrier()
+
+            try:
+                self.memory.close()
+            except BufferError:
+                pass # still exported to arrays, unmapped once they are gone
+
+    class Pool(object):
+        """Interface to processes forked on first use.
+
+        This mimics the parts of the MPI interface used within elphmod. As with
+        ``mpirun``, all processes run the same program after the first use of
+        a communicator, so that the parallelized routines scale across the
+        cores of a single machine without MPI.
+
+        If a process terminates with an uncaught exception, it notifies all
+        others, which then terminate as well. Processes waiting for messages
+        also check regularly whether their parent or children are still alive.
+        """
+        def __init__(self, processes):
+            self.processes = processes
+
+            self.started = False
+
+            self.rank = 0
+
+            self.COMM_WORLD = PoolCommunicator(self, list(range(processes)),
+                ())
+
+            self.COMM_SELF = PoolCommunicator(self, None, ('self',))
+
+            self.UNSIGNED_CHAR = Datatype()
+
+            self.UNDEFINED = 0
+            self.COMM_TYPE_SHARED = 1
+            self.LOCK_SHARED = 1
+            self.LOCK_EXCLUSIVE = 2
+            self.SUM = None
+
+            self.Win = Window
 
-    MPI = Interface()
+        def start(self):
+            """Fork processes, unless already done."""
+
+            if self.started:
+                return
+
+            self.started = True
+
+            import atexit
+            import multiprocessing
+
+            context = multiprocessing.get_context('fork')
+
+            self.queues = [context.Queue() for rank in range(self.processes)]
+            self.lock = context.Lock()
+            self.mailbox = dict()
+
+            self.parent = os.getpid()
+            self.children = []
+
+            for rank in range(1, self.processes):
+                pid = os.fork()
+
+                if pid == 0:
+                    self.rank = rank
+                    self.children = []
+                    break
+
+                self.children.append(pid)
+            else:
+                atexit.register(self.finish)
+
+            hook = sys.excepthook
+
+            def excepthook(*args):
+                hook(*args)
+                self.abort(notify=True)
+
+            sys.excepthook = excepthook
+
+        def receive(self):
+            """Get next message for current process, aborting if necessary."""
+
+            import queue
+
+            while True:
+                try:
+                    message = self.queues[self.rank].get(timeout=1.0)
+                except queue.Empty:
+                    self.check()
+                    continue
+
+                if message is None: # another process has failed
+                    self.abort()
+
+                return message
+
+        def check(self):
+            """Abort if parent or any child process has died."""
+
+            if self.rank != 0:
+                if os.getppid() != self.parent:
+                    self.abort()
+
+                return
+
+            for pid in list(self.children):
+                done, status = os.waitpid(pid, os.WNOHANG)
+
+                if done:
+                    self.children.remove(pid)
+
+                    if status != 0:
+                        sys.stderr.write('Process %d failed\n' % pid)
+                        self.abort(notify=True)
+
+        def finish(self):
+            """Wait for child processes and fail if any of them has failed."""
+
+            failed = False
+
+            for pid in self.children:
+                failed |= os.waitpid(pid, 0)[1] != 0
+
+            if failed:
+                sys.stderr.write('Child process failed\n')
+                os._exit(1)
+
+        def abort(self, notify=False):
+            """Terminate current process and, from first process, all others."""
+
+            import signal
+
+            if notify:
+                for rank, queue in enumerate(self.queues):
+                    if rank != self.rank:
+                        queue.put(None)
+                        queue.close()
+                        queue.join_thread()
+
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+            os._exit(1)
+
+    processes = int(os.environ.get('ELPHMOD_PROCESSES', 1))
+
+    if processes > 1:
+        MPI = Pool(processes)
+    else:
+        MPI = Interface()
 
 comm = MPI.COMM_WORLD
+single = MPI.COMM_SELF # to run parallelized routines on a single process
 
 def distribute(size, bounds=False, comm=comm, chunks=None):
     """Distribute work among processes."""
@@ -93,6 +505,210 @@ def distribute(size, bounds=False, comm=comm, chunks=None):
 
     return sizes
 
+def dynamic(items, comm=comm):
+    """Distribute work among processes on demand.
+
+    Instead of assigning fixed blocks of items to the processes, each process
+    fetches the next unprocessed item from a counter on the first process as
+    soon as it is done with the previous one. This balances the load if the
+    cost per item varies. The results can be put back in order via
+    :func:`collect`.
+
+    Example:
+
+    .. code-block:: python
+
+        my_iq = []
+        my_Pi = []
+
+        for iq in dynamic(range(nQ)):
+            my_iq.append(iq)
+            my_Pi.append(expensive(q[iq]))
+
+        Pi = np.empty(nQ)
+
+        collect(my_iq, my_Pi, Pi)
+
+    Parameters
+    ----------
+    items : sequence
+        Items to be processed, e.g., ``range(n)``.
+    comm : MPI.Intracomm
+        Group of processes sharing the work. All processes of this group must
+        iterate until the end.
+
+    Yields
+    ------
+    object
+        Next item to be processed by the current process.
+
+    Notes
+    -----
+    The counter is accessed via passive-target one-sided communication (MPI-3
+    RMA) in memory allocated by MPI, which allows for hardware atomics. Since
+    the first process works on items as well, whether the others can fetch the
+    next item while it is busy still depends on the MPI implementation. If it
+    does not progress one-sided operations asynchronously, they may have to
+    wait until the first process calls MPI again, e.g., when fetching its next
+    item. In this case, asynchronous progress should be enabled, e.g., via
+    ``MPICH_ASYNC_PROGRESS=1``, or the work should be split into many small
+    items.
+    """
+    if comm.size == 1:
+        for item in items:
+            yield item
+
+        return
+
+    one = np.ones(1, dtype=int)
+    index = np.empty(1, dtype=int)
+
+    # shared counter on first process:
+
+    window = MPI.Win.Allocate(one.itemsize if comm.rank == 0 else 0,
+        one.itemsize, comm=comm)
+
+    if comm.rank == 0:
+        window.Lock(0, MPI.LOCK_EXCLUSIVE)
+        window.Put(np.zeros(1, dtype=int), 0)
+        window.Unlock(0)
+
+    comm.Barrier()
+
+    while True:
+        window.Lock(0, MPI.LOCK_SHARED)
+        window.Fetch_and_op(one, index, 0, 0, MPI.SUM)
+        window.Unlock(0)
+
+        if index[0] >= len(items):
+            break
+
+        yield items[index[0]]
+
+    window.Free()
+
+def parallel(function, items, threads=1, comm=comm):
+    """Apply function to items distributed among processes and threads.
+
+    The items are handed out on demand via :func:`dynamic`. Within each
+    process, they are further processed by a pool of threads, which is useful
+    if `function` mainly calls NumPy routines that release the global
+    interpreter lock.
+
+    Parameters
+    ----------
+    function : function
+        Function of a single item.
+    items : sequence
+        Items to be processed.
+    threads : int
+        Number of threads per process.
+    comm : MPI.Intracomm
+        Group of processes sharing the work.
+
+    Returns
+    -------
+    list
+        Items processed by the current process.
+    list
+        Corresponding function values. Both lists can be passed to
+        :func:`collect`.
+
+    Notes
+    -----
+    If `function` raises an exception in one of the threads, this thread stops
+    and the first such exception is raised again once all threads are done.
+    """
+    queue = dynamic(items, comm=comm)
+    lock = threading.Lock()
+    end = object()
+
+    my_items = []
+    my_values = []
+
+    errors = []
+
+    def work():
+        while True:
+            with lock:
+                item = next(queue, end)
+
+            if item is end:
+                return
+
+            value = function(item)
+
+            with lock:
+                my_items.append(item)
+                my_values.append(value)
+
+    def guarded_work():
+        try:
+            work()
+        except Exception as error:
+            with lock:
+                errors.append(error)
+
+    if threads > 1:
+        pool = [threading.Thread(target=guarded_work)
+            for thread in range(threads)]
+
+        for thread in pool:
+            thread.start()
+
+        for thread in pool:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+    else:
+        work()
+
+    return my_items, my_values
+
+def collect(items, data, recv, broadcast=True, comm=comm):
+    """Gather results of dynamically distributed work in original order.
+
+    Parameters
+    ----------
+    items : list of int
+        Indices of the items processed by the current process, e.g., as
+        obtained from :func:`dynamic`.
+    data : list of ndarray
+        Corresponding results of the current process.
+    recv : ndarray
+        Array for all results, with the item index as first dimension. It only
+        has to be allocated on the first process if `broadcast` is ``False``.
+    broadcast : bool
+        Make results available to all processes? Otherwise, they are only
+        gathered on the first process.
+    comm : MPI.Intracomm
+        Group of processes that shared the work.
+
+    Notes
+    -----
+    The results are sent one by one and received by the first process directly
+    at their final position in `recv`, such that no further copy of all results
+    is needed.
+    """
+    order = comm.gather(list(items))
+
+    dtype = comm.bcast(recv.dtype if comm.rank == 0 else None)
+
+    if comm.rank == 0:
+        for item, value in zip(items, data):
+            recv[item] = value
+
+        for rank in range(1, comm.size):
+            for item in order[rank]:
+                comm.Recv(recv[item:item + 1], source=rank)
+    else:
+        for value in data:
+            comm.Send(np.ascontiguousarray(value, dtype=dtype), dest=0)
+
+    if broadcast:
+        comm.Bcast(recv)
+
 def matrix(size, comm=comm):
     """Create sub-communicators."""
 
@@ -190,6 +806,127 @@ def shared_array(shape, dtype=float, shared_memory=True, single_memory=False,
 
     return node, images, array
 
+class DiskArray(object):
+    """Array stored block by block along its first axis in a directory.
+
+    Each block ``array[i]`` is kept in a separate NumPy file, which is only
+    memory-mapped when accessed. Arrays too large for the memory of a single
+    node can thus be written by different processes and read lazily.
+
+    Example:
+
+    .. code-block:: python
+
+        array = DiskArray('data', (nq, nk, nk), dtype=complex)
+
+        for iq in dynamic(range(nq)):
+            array[iq] = expensive(q[iq])
+
+        comm.Barrier()
+
+        for iq in range(len(array)):
+            do_something(array[iq])
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing the blocks, created if necessary.
+    shape : tuple of int, optional
+        Shape of new array. If omitted, an existing array is opened.
+    dtype : type
+        Data type of new array.
+    comm : MPI.Intracomm
+        Group of processes sharing the array.
+
+    Attributes
+    ----------
+    directory : str
+        Directory containing the blocks.
+    shape : tuple of int
+        Shape of the array, which can be changed via :meth:`reshape`.
+    dtype : numpy.dtype
+        Data type of the array.
+    """
+    def __init__(self, directory, shape=None, dtype=float, comm=comm):
+        self.directory = directory
+
+        header = os.path.join(directory, 'header.npz')
+
+        if shape is not None:
+            if comm.rank == 0:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+                np.savez(header, shape=np.array(shape, dtype=int),
+                    dtype=np.empty(0, dtype=dtype))
+
+            comm.Barrier()
+
+        with np.load(header) as data:
+            self.shape = tuple(int(n) for n in data['shape'])
+            self.dtype = data['dtype'].dtype
+
+        self.stored = self.shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def file(self, i):
+        """Get name of file containing given block."""
+
+        return os.path.join(self.directory, '%d.npy' % i)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        blocks = np.arange(self.shape[0])[index[0]]
+
+        if blocks.ndim == 0:
+            block = np.load(self.file(blocks), mmap_mode='r')
+
+            return np.reshape(block, self.shape[1:])[index[1:]]
+
+        return np.array([self[(i,) + index[1:]] for i in blocks])
+
+    def __setitem__(self, i, block):
+        np.save(self.file(range(self.shape[0])[i]),
+            np.reshape(np.asarray(block, dtype=self.dtype), self.stored))
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def reshape(self, *shape, **kwargs):
+        """Change shape of blocks without reading them.
+
+        Parameters
+        ----------
+        *shape : int
+            New shape, whose first dimension must agree with the number of
+            blocks. One dimension may be -1.
+
+        Returns
+        -------
+        DiskArray
+            Lazily reshaped view of the same blocks.
+        """
+        if len(shape) == 1 and not np.isscalar(shape[0]):
+            shape = tuple(shape[0])
+
+        size = np.prod(self.stored, dtype=int)
+        known = -np.prod(shape[1:], dtype=int)
+
+        shape = tuple(int(size // known if n == -1 else n) for n in shape)
+
+        if shape[0] != self.shape[0] or np.prod(shape[1:]) != size:
+            info("Cannot reshape %s to %s" % (self.shape, shape), error=True)
+
+        view = DiskArray.__new__(DiskArray)
+        view.__dict__.update(self.__dict__)
+        view.shape = shape
+
+        return view
+
 def load(filename, comm=comm):
     """Read and broadcast NumPy data."""
 
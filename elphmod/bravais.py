@@ -952,6 +952,50 @@ def Fourier_interpolation(data, angle=60, sign=-1, hr_file=None, function=True):
 
     return dict((tuple(point), value) for point, value in zip(points, values))
 
+def Fourier_mesh(R, data, nk, sign=1):
+    r"""Evaluate lattice Fourier series on uniform mesh via FFT.
+
+    .. math::
+
+        X_{\vec k} = \sum_{\vec R} X_{\vec R} \exp(\pm \I \vec k \vec R)
+
+    The data for all lattice vectors is accumulated on a periodic grid with
+    the size of the mesh, such that equivalent lattice vectors (e.g., images
+    on the Wigner-Seitz boundary with their degeneracy already divided out)
+    are summed up. Then a single multidimensional FFT is performed.
+
+    Parameters
+    ----------
+    R : ndarray
+        Lattice vectors in crystal coordinates (integers), one per row.
+    data : ndarray
+        Corresponding data, where the first axis belongs to the lattice vectors.
+    nk : tuple of int
+        Number of mesh points per dimension. If there are fewer dimensions than
+        columns of `R`, the remaining k-point coordinates are set to zero.
+    sign : int
+        Sign in exponential function.
+
+    Returns
+    -------
+    ndarray
+        Data on uniform k mesh, where the first axes belong to the mesh-point
+        indices :math:`k_i = 2 \pi K_i / n_i`.
+    """
+    nk = tuple(nk)
+    axes = tuple(range(len(nk)))
+
+    grid = np.zeros(nk + data.shape[1:], dtype=complex)
+
+    R = np.asarray(R, dtype=int)
+
+    np.add.at(grid, tuple(R[:, i] % nk[i] for i in axes), data)
+
+    if sign > 0:
+        return np.fft.ifftn(grid, axes=axes) * np.prod(nk)
+    else:
+        return np.fft.fftn(grid, axes=axes)
+
 def path(points, b, N=30):
     """Generate arbitrary path through Brillouin zone.
 
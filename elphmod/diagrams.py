@@ -46,9 +46,6 @@ def susceptibility(e, kT=0.025, eta=1e-10, occupations=occupations.fermi_dirac):
     f = occupations(x)
     d = occupations.delta(x).sum() / kT
 
-    e = np.tile(e, (2, 2))
-    f = np.tile(f, (2, 2))
-
     scale = nk / (2 * np.pi)
     eta2 = eta ** 2
     prefactor = 2.0 / nk ** 2
@@ -60,14 +57,15 @@ def susceptibility(e, kT=0.025, eta=1e-10, occupations=occupations.fermi_dirac):
         if q1 == q2 == 0:
             return -prefactor * d
 
-        df = f[q1:q1 + nk, q2:q2 + nk] - f[:nk, :nk]
-        de = e[q1:q1 + nk, q2:q2 + nk] - e[:nk, :nk]
+        df = shift(f, q1, q2) - f
+        de = shift(e, q1, q2) - e
 
         return prefactor * np.sum(df * de / (de * de + eta2))
 
     return calculate_susceptibility
 
-def susceptibility2(e, kT=0.025, nmats=1000, hyb_width=1.0, hyb_height=0.0):
+def susceptibility2(e, kT=0.025, nmats=1000, hyb_width=1.0, hyb_height=0.0,
+        dense=None, chunk=100):
     r"""Calculate the Lindhardt bubble using the Green's functions explicitly.
 
     .. math::
@@ -99,48 +97,163 @@ def susceptibility2(e, kT=0.025, nmats=1000, hyb_width=1.0, hyb_height=0.0):
         Width of box-shaped hybridization function.
     hyb_height : float
         Height of box-shaped hybridization function.
+    dense : int
+        Number of lowest Matsubara frequencies summed over explicitly. By
+        default, this applies to all `nmats` frequencies. See
+        :func:`matsubara_frequencies`.
+    chunk : int
+        Number of Matsubara frequencies processed at once. Only the Green's
+        functions for these frequencies are stored.
 
     Returns
     -------
     function
         Static electronic susceptibility as a function of :math:`q_1, q_2 \in
-        [0, 2 \pi)`.
+        [0, 2 \pi)`. Its attribute ``mesh`` returns the susceptibility on the
+        whole uniform q mesh at once via FFTs, taking the number of q points per
+        dimension (defaults to k mesh).
     """
     nk, nk = e.shape
 
-    e = np.tile(e, (2, 2))
-
     scale = nk / (2 * np.pi)
 
     prefactor = kT * 4.0 / nk ** 2
     # factor 2 for the negative Matsubara frequencies
     # factor 2 for the spin
 
-    nu = (2 * np.arange(nmats) + 1) * np.pi * kT # Matsubara frequencies
+    nu, weight = matsubara_frequencies(kT, nmats, dense)
 
     Delta = -2j * hyb_height * np.arctan(2 * hyb_width / nu) # hybridization
 
-    G = np.empty((nmats, 2 * nk, 2 * nk), dtype=complex) # Green's functions
+    # sum over k of G(k) G(k + q) as cross-correlation via FFTs:
+
+    chi = np.zeros((nk, nk), dtype=complex)
+
+    for n in range(0, len(nu), chunk):
+        window = slice(n, n + chunk)
 
-    for i in range(nmats):
-        G[i] = 1.0 / (1j * nu[i] - e - Delta[i])
+        G = 1.0 / (1j * nu[window, None, None] - e - Delta[window, None, None])
 
-    tail = -2.0 / (4 * kT) + prefactor * nk ** 2 * np.sum(1.0 / nu ** 2)
+        chi += np.einsum('n,nkl->kl', weight[window],
+            np.fft.fft2(G) * np.fft.ifft2(G))
+
+    chi = np.fft.ifft2(chi) * nk ** 2
+
+    tail = -2.0 / (4 * kT) + prefactor * nk ** 2 * np.sum(weight / nu ** 2)
     # see Appendix B of the thesis of Hartmut Hafermann
     # factor 2 for spin
     # VERIFY THAT THIS IS CORRECT! (after rewriting function)
 
+    chi = prefactor * chi + tail
+
     def calculate_susceptibility(q1=0, q2=0):
         q1 = int(round(q1 * scale)) % nk
         q2 = int(round(q2 * scale)) % nk
 
-        Gk  = G[:, :nk, :nk]
-        Gkq = G[:, q1:q1 + nk, q2:q2 + nk]
+        return chi[q1, q2]
+
+    def calculate_susceptibility_mesh(nq=None):
+        return on_q_mesh(chi, nq)
 
-        return prefactor * np.sum(Gk * Gkq) + tail
+    calculate_susceptibility.mesh = calculate_susceptibility_mesh
 
     return calculate_susceptibility
 
+def matsubara_frequencies(kT=0.025, nmats=1000, dense=None):
+    """Set up fermionic Matsubara frequencies with integration weights.
+
+    The lowest `dense` frequencies have unit weight. The remaining ones up to
+    `nmats` are grouped into blocks, whose size grows linearly with their
+    distance from the origin and which are represented by their central
+    frequency weighted by the block size. Summands that vary slowly at high
+    frequencies can thus be summed over a large number of Matsubara
+    frequencies at the cost of a few hundred evaluations.
+
+    Parameters
+    ----------
+    kT : float
+        Temperature.
+    nmats : int
+        Number of positive fermionic Matsubara frequencies to be summed over.
+    dense : int
+        Number of frequencies with unit weight. Defaults to `nmats`.
+
+    Returns
+    -------
+    ndarray
+        Matsubara frequencies.
+    ndarray
+        Corresponding weights.
+    """
+    if dense is None or dense >= nmats:
+        dense = nmats
+
+    dense = max(dense, 1)
+
+    n = list(range(dense))
+    weight = [1] * dense
+
+    first = dense
+
+    while first < nmats:
+        size = min(first // dense, nmats - first)
+
+        n.append(first + (size - 1) / 2)
+        weight.append(size)
+
+        first += size
+
+    nu = (2 * np.array(n, dtype=float) + 1) * np.pi * kT
+
+    return nu, np.array(weight, dtype=float)
+
+def on_q_mesh(chi, nq=None):
+    """Pick values on q mesh from values on (typically denser) k mesh.
+
+    Parameters
+    ----------
+    chi : ndarray
+        Quantity on uniform k mesh.
+    nq : int
+        Number of q points per dimension. Defaults to k mesh.
+
+    Returns
+    -------
+    ndarray
+        Quantity at the k points nearest to the points of the q mesh.
+    """
+    nk = chi.shape[0]
+
+    if nq is None or nq == nk:
+        return chi
+
+    q = 2 * np.pi / nq * np.arange(nq)
+    q = np.array([int(round(q1 * nk / (2 * np.pi))) % nk for q1 in q])
+
+    return chi[np.ix_(q, q)]
+
+def shift(x, q1, q2):
+    """Evaluate quantity given on uniform k mesh at shifted points k + q.
+
+    Instead of tiling the whole array to slice the k + q window, only the
+    requested window is gathered via periodic index arithmetic.
+
+    Parameters
+    ----------
+    x : ndarray
+        Quantity on uniform k mesh, with k1 and k2 as first two dimensions.
+    q1, q2 : int
+        Shift in units of the k-mesh spacing.
+
+    Returns
+    -------
+    ndarray
+        Array with elements ``x[(k1 + q1) % nk1, (k2 + q2) % nk2, ...]``.
+    """
+    nk1, nk2 = x.shape[:2]
+
+    return x[np.ix_((np.arange(nk1) + q1) % nk1, (np.arange(nk2) + q2) % nk2)]
+
 def polarization(e, U, kT=0.025, eps=1e-15, subspace=None,
         occupations=occupations.fermi_dirac):
     r"""Calculate RPA polarization in orbital basis (density-density).
@@ -203,34 +316,28 @@ def polarization(e, U, kT=0.025, eps=1e-15, subspace=None,
     f = occupations(x)
     d = occupations.delta(x) / (-kT)
 
-    e = np.tile(e, (2, 2, 1))
-    f = np.tile(f, (2, 2, 1))
-    U = np.tile(U, (2, 2, 1, 1))
-
-    if cRPA:
-        subspace = np.tile(subspace, (2, 2, 1))
-
     scale = nk / (2 * np.pi)
     prefactor = 2.0 / nk ** 2
 
-    k1 = slice(0, nk)
-    k2 = k1
-
     dfde = np.empty((nk, nk))
 
     def calculate_polarization(q1=0, q2=0):
         q1 = int(round(q1 * scale)) % nk
         q2 = int(round(q2 * scale)) % nk
 
-        kq1 = slice(q1, q1 + nk)
-        kq2 = slice(q2, q2 + nk)
+        ekq = shift(e, q1, q2)
+        fkq = shift(f, q1, q2)
+        Ukq = shift(U, q1, q2)
+
+        if cRPA:
+            subspace_kq = shift(subspace, q1, q2)
 
         Pi = np.empty((nb, nb, no, no), dtype=complex)
 
         for m in range(nb):
             for n in range(nb):
-                df = f[kq1, kq2, m] - f[k1, k2, n]
-                de = e[kq1, kq2, m] - e[k1, k2, n]
+                df = fkq[:, :, m] - f[:, :, n]
+                de = ekq[:, :, m] - e[:, :, n]
 
                 ok = abs(de) > eps
 
@@ -239,11 +346,11 @@ def polarization(e, U, kT=0.025, eps=1e-15, subspace=None,
 
                 if cRPA:
                     exclude = np.where(
-                        subspace[kq1, kq2, m] & subspace[k1, k2, n])
+                        subspace_kq[:, :, m] & subspace[:, :, n])
 
                     dfde[exclude] = 0.0
 
-                UU = U[kq1, kq2, :, m].conj() * U[k1, k2, :, n]
+                UU = Ukq[:, :, :, m].conj() * U[:, :, :, n]
 
                 Pi[m, n] = np.einsum('kla,kl,klb->ab', UU.conj(), dfde, UU)
 
@@ -254,7 +361,7 @@ def polarization(e, U, kT=0.025, eps=1e-15, subspace=None,
 def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
         occupations=occupations.fermi_dirac, fluctuations=False, Delta=None,
         Delta_diff=False, Delta_occupations=occupations.gauss, Delta_kT=0.025,
-        comm=comm):
+        cutoff=None, threads=1, comm=comm):
     r"""Calculate phonon self-energy.
 
     .. math::
@@ -271,8 +378,9 @@ def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
         [0, 2 \pi)`.
     e : ndarray
         Electron dispersion on uniform mesh. The Fermi level must be at zero.
-    g2 : ndarray
-        Squared electron-phonon coupling.
+    g2 : ndarray or MPI.DiskArray
+        Squared electron-phonon coupling. If stored on disk, it is read q point
+        by q point.
     kT : float
         Smearing temperature.
     eps : float
@@ -289,6 +397,14 @@ def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
         Smoothened Heaviside function to realize excluded energy window.
     Delta_kT : float
         Temperature to smoothen Heaviside function.
+    cutoff : float, optional
+        Energy window around the Fermi level. Pairs of bands that both lie
+        entirely below ``-cutoff`` or entirely above ``cutoff`` are skipped.
+        By the mean value theorem, each neglected value of the above fraction
+        is bounded by ``occupations.delta(cutoff / kT) / kT``, e.g., about
+        ``4 exp(-cutoff / kT)`` times its maximum for Fermi-Dirac smearing.
+    threads : int
+        Number of threads per process working on different q points.
 
     Returns
     -------
@@ -302,7 +418,7 @@ def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
     nbnd = e.shape[-1]
 
     if g2 is None:
-        g2 = np.ones((nQ, 1))
+        g2 = np.ones((nQ, 1, 1, 1, 1, 1))
 
     else:
         g2 = np.reshape(g2, (nQ, -1, nk, nk, nbnd, nbnd))
@@ -324,75 +440,81 @@ def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
             delta = Delta_occupations.delta(x1) + Delta_occupations.delta(x2)
             delta /= -Delta_kT
 
-    e = np.tile(e, (2, 2, 1))
-    f = np.tile(f, (2, 2, 1))
+    scale = nk / (2 * np.pi)
+    prefactor = 2.0 / nk ** 2
 
-    if Delta is not None:
-        Theta = np.tile(Theta, (2, 2, 1))
+    if cutoff is None:
+        # band indices m and n correspond to the last two axes:
 
-        if Delta_diff:
-            delta = np.tile(delta, (2, 2, 1))
+        kq = (slice(None), slice(None), slice(None), None)
+        k = (slice(None), slice(None), None, slice(None))
 
-    scale = nk / (2 * np.pi)
-    prefactor = 2.0 / nk ** 2
+        indices = 'xklmn,klmn->x'
 
-    sizes, bounds = MPI.distribute(nQ, bounds=True, comm=comm)
+    else:
+        # compressed list of relevant band pairs (m, n) along the last axis:
 
-    my_Pi = np.empty((sizes[comm.rank], nb), dtype=g2.dtype)
+        below = np.all(e < -cutoff, axis=(0, 1))
+        above = np.all(e > cutoff, axis=(0, 1))
 
-    if fluctuations:
-        my_Pi_k = np.empty((sizes[comm.rank], nb, nk, nk, nbnd, nbnd),
-            dtype=g2.dtype)
+        m, n = np.nonzero(~(np.outer(below, below) | np.outer(above, above)))
 
-    dfde = np.empty((nk, nk, nbnd, nbnd))
+        kq = (slice(None), slice(None), m)
+        k = (slice(None), slice(None), n)
 
-    k1 = slice(0, nk)
-    k2 = slice(0, nk)
+        indices = 'xklp,klp->x'
 
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+    def calculate_phonon_self_energy(iq):
         q1 = int(round(q[iq, 0] * scale)) % nk
         q2 = int(round(q[iq, 1] * scale)) % nk
 
-        kq1 = slice(q1, q1 + nk)
-        kq2 = slice(q2, q2 + nk)
+        df = shift(f, q1, q2)[kq] - f[k]
+        de = shift(e, q1, q2)[kq] - e[k]
 
-        for m in range(nbnd):
-            for n in range(nbnd):
-                df = f[kq1, kq2, m] - f[k1, k2, n]
-                de = e[kq1, kq2, m] - e[k1, k2, n]
+        ok = abs(de) > eps
 
-                ok = abs(de) > eps
+        dfde = np.where(ok, df / np.where(ok, de, 1.0), d[k])
 
-                dfde[:, :, m, n][ ok] = df[ok] / de[ok]
-                dfde[:, :, m, n][~ok] = d[:, :, n][~ok]
+        if Delta is not None:
+            Theta_kq = shift(Theta, q1, q2)[kq]
+
+            if Delta_diff:
+                delta_kq = shift(delta, q1, q2)[kq]
 
-                if Delta is not None:
-                    if Delta_diff:
-                        envelope = (
-                              Theta[kq1, kq2, m] * delta[k1, k2, n]
-                            + delta[kq1, kq2, m] * Theta[k1, k2, n]
-                            )
-                    else:
-                        envelope = Theta[kq1, kq2, m] * Theta[k1, k2, n]
+                dfde *= Theta_kq * delta[k] + delta_kq * Theta[k]
+            else:
+                dfde *= Theta_kq * Theta[k]
 
-                    dfde[:, :, m, n] *= envelope
+        if cutoff is None:
+            g2_q = g2[iq]
+        else:
+            g2_q = np.broadcast_to(g2[iq], (nb, nk, nk, nbnd, nbnd))[..., m, n]
 
-        for nu in range(nb):
-            Pi_k = g2[iq, nu] * dfde
+        if fluctuations:
+            Pi_k = g2_q * dfde
+            Pi = prefactor * Pi_k.reshape(nb, -1).sum(axis=1)
 
-            my_Pi[my_iq, nu] = prefactor * Pi_k.sum()
+            if cutoff is not None:
+                Pi_k_pairs = Pi_k
 
-            if fluctuations:
-                my_Pi_k[my_iq, nu] = 2 * Pi_k
+                Pi_k = np.zeros((nb, nk, nk, nbnd, nbnd), dtype=Pi_k.dtype)
+                Pi_k[..., m, n] = Pi_k_pairs
+
+            return Pi, 2 * Pi_k
+
+        return (prefactor * np.einsum(indices, g2_q, dfde),)
+
+    my_iq, my_Pi = MPI.parallel(calculate_phonon_self_energy, range(nQ),
+        threads, comm)
 
     Pi = np.empty((nQ, nb), dtype=g2.dtype)
 
-    comm.Allgatherv(my_Pi, (Pi, sizes * nb))
+    MPI.collect(my_iq, [Pi_q[0] for Pi_q in my_Pi], Pi, comm=comm)
 
     if fluctuations:
         Pi_k = np.empty((nQ, nb, nk, nk, nbnd, nbnd), dtype=g2.dtype)
 
-        comm.Allgatherv(my_Pi_k, (Pi_k, sizes * nb * nk * nk * nbnd * nbnd))
+        MPI.collect(my_iq, [Pi_q[1] for Pi_q in my_Pi], Pi_k, comm=comm)
 
         return Pi, Pi_k
 
@@ -400,7 +522,7 @@ def phonon_self_energy(q, e, g2=None, kT=0.025, eps=1e-15,
         return Pi
 
 def phonon_self_energy2(q, e, g2, kT=0.025, nmats=1000, hyb_width=1.0,
-        hyb_height=0.0, GB=4.0):
+        hyb_height=0.0, GB=4.0, dense=None, chunk=None):
     """Calculate phonon self-energy using the Green's functions explicitly.
 
     Parameters
@@ -421,7 +543,15 @@ def phonon_self_energy2(q, e, g2, kT=0.025, nmats=1000, hyb_width=1.0,
     hyb_height : float
         Height of box-shaped hybridization function.
     GB : float
-        Memory limit in gigabytes. Exit if exceeded.
+        Memory budget in gigabytes for the Green's functions of all processes,
+        which determines how many Matsubara frequencies are processed at once.
+    dense : int
+        Number of lowest Matsubara frequencies summed over explicitly. By
+        default, this applies to all `nmats` frequencies. See
+        :func:`matsubara_frequencies`.
+    chunk : int
+        Number of Matsubara frequencies processed at once. Only the Green's
+        functions for these frequencies are stored. Overrides `GB`.
 
     Returns
     -------
@@ -435,51 +565,67 @@ def phonon_self_energy2(q, e, g2, kT=0.025, nmats=1000, hyb_width=1.0,
     nk, nk = e.shape
     nQ, nb, nk, nk = g2.shape
 
-    if nmats * (2 * nk) ** 2 * np.dtype(complex).itemsize * comm.size > GB * 1e9:
-        info("Error: Memory limit (%g GB) exceeded!" % GB)
-        quit()
+    if chunk is None:
+        # G, weighted G, G at k + q, and their product per frequency:
+
+        size = 4 * nk ** 2 * np.dtype(complex).itemsize * comm.size
 
-    e = np.tile(e, (2, 2))
+        chunk = max(1, int(GB * 1e9 / size))
 
     scale = nk / (2 * np.pi)
     prefactor = kT * 4.0 / nk ** 2
 
-    nu = (2 * np.arange(nmats) + 1) * np.pi * kT # Matsubara frequencies
+    nu, weight = matsubara_frequencies(kT, nmats, dense)
 
     Delta = -2j * hyb_height * np.arctan(2 * hyb_width / nu) # hybridization
 
-    G = np.empty((nmats, 2 * nk, 2 * nk), dtype=complex) # Green's functions
-
-    for i in range(nmats):
-        G[i] = 1.0 / (1j * nu[i] - e - Delta[i])
-
-    tail = -2.0 / (4 * kT) / nk ** 2 + prefactor * np.sum(1.0 / nu ** 2)
+    tail = -2.0 / (4 * kT) / nk ** 2 + prefactor * np.sum(weight / nu ** 2)
     # VERIFY THAT THIS IS CORRECT!
 
+    # Distribute q points over rows and frequency chunks over columns of
+    # processes. The q points stay with the same processes for all chunks:
+
     sizes, bounds = MPI.distribute(nQ, bounds=True)
+    col, row = MPI.matrix(nQ)
 
-    my_Pi = np.empty((sizes[comm.rank], nb), dtype=complex)
+    my_q = range(*bounds[row.rank:row.rank + 2])
 
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
-        q1 = int(round(q[iq, 0] * scale)) % nk
-        q2 = int(round(q[iq, 1] * scale)) % nk
+    my_Pi = np.zeros((nQ, nb), dtype=complex)
+
+    if col.rank == 0:
+        for iq in my_q:
+            my_Pi[iq] = tail * g2[iq].sum(axis=(1, 2))
+
+    chunks = range(0, len(nu), chunk)
+
+    for n in chunks[col.rank::col.size]:
+        window = slice(n, n + chunk)
+
+        # k points first to gather k + q via shift:
+
+        G = 1.0 / (1j * nu[window] - e[:, :, None] - Delta[window])
+
+        wG = weight[window] * G
+
+        for iq in my_q:
+            q1 = int(round(q[iq, 0] * scale)) % nk
+            q2 = int(round(q[iq, 1] * scale)) % nk
 
-        Gk  = G[:, :nk, :nk]
-        Gkq = G[:, q1:q1 + nk, q2:q2 + nk]
+            chi = prefactor * np.sum(wG * shift(G, q1, q2), axis=2).real
 
-        chi = prefactor * np.sum(Gk * Gkq, axis=0).real + tail
+            my_Pi[iq] += np.einsum('xkl,kl->x', g2[iq], chi)
 
-        for nu in range(nb):
-            my_Pi[my_iq, nu] = np.sum(g2[iq, nu] * chi)
+        del G, wG
 
     Pi = np.empty((nQ, nb), dtype=complex)
 
-    comm.Allgatherv(my_Pi, (Pi, sizes * nb))
+    comm.Allreduce(my_Pi, Pi)
 
     return Pi
 
 def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
-        occupations=occupations.fermi_dirac, nbnd_sub=None, status=True):
+        occupations=occupations.fermi_dirac, nbnd_sub=None, status=True,
+        threads=1, storage=None):
     r"""Calculate renormalized electron-phonon coupling in band basis.
 
     .. math::
@@ -501,8 +647,9 @@ def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
         [0, 2 \pi)`.
     e : ndarray
         Electron dispersion on uniform mesh. The Fermi level must be at zero.
-    g : ndarray
-        Bare electron-phonon coupling in band basis.
+    g : ndarray or MPI.DiskArray
+        Bare electron-phonon coupling in band basis. If stored on disk, it is
+        read q point by q point.
     W : ndarray
         Dressed q-dependent Coulomb interaction in orbital basis.
     U : ndarray
@@ -517,10 +664,15 @@ def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
         Number of bands for Lindhard bubble. Defaults to all bands.
     status : bool
         Print status messages during the calculation?
+    threads : int
+        Number of threads per process working on different q points.
+    storage : str, optional
+        Directory to which the dressed coupling is written q point by q point
+        instead of being gathered in memory.
 
     Returns
     -------
-    ndarray
+    ndarray or MPI.DiskArray
         Dressed electron-phonon coupling in band basis.
 
     See Also
@@ -547,37 +699,32 @@ def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
     f = occupations(x)
     d = occupations.delta(x) / (-kT)
 
-    e = np.tile(e, (2, 2, 1))
-    f = np.tile(f, (2, 2, 1))
-    U = np.tile(U, (2, 2, 1, 1))
-
     scale = nk / (2 * np.pi)
     prefactor = 2.0 / nk ** 2
 
-    sizes, bounds = MPI.distribute(nQ, bounds=True)
-
-    my_g_ = np.empty((sizes[comm.rank], nmodes, nk, nk, nbnd, nbnd),
-        dtype=complex)
-
-    dfde = np.empty((nk, nk, nbnd_sub, nbnd_sub))
+    if storage is not None:
+        g_ = MPI.DiskArray(storage, (nQ, nmodes, nk, nk, nbnd, nbnd),
+            dtype=complex)
 
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+    def renormalize(iq):
         if status:
             print('Renormalize coupling for q point %d..' % (iq + 1))
 
         q1 = int(round(q[iq, 0] * scale)) % nk
         q2 = int(round(q[iq, 1] * scale)) % nk
 
-        k1 = slice(0, nk)
-        k2 = slice(0, nk)
+        ekq = shift(e, q1, q2)
+        fkq = shift(f, q1, q2)
+        Ukq = shift(U, q1, q2)
 
-        kq1 = slice(q1, q1 + nk)
-        kq2 = slice(q2, q2 + nk)
+        gq = g[iq]
+
+        dfde = np.empty((nk, nk, nbnd_sub, nbnd_sub))
 
         for m in range(nbnd_sub):
             for n in range(nbnd_sub):
-                df = f[kq1, kq2, m] - f[k1, k2, n]
-                de = e[kq1, kq2, m] - e[k1, k2, n]
+                df = fkq[:, :, m] - f[:, :, n]
+                de = ekq[:, :, m] - e[:, :, n]
 
                 ok = abs(de) > eps
 
@@ -590,16 +737,15 @@ def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
             indices = 'KLcM,KLdN,KLMN,xKLMN->xcd'
 
         Pig = prefactor * np.einsum(indices,
-            U[kq1, kq2, :, :nbnd_sub], U[k1, k2, :, :nbnd_sub].conj(),
-            dfde, g[iq, :, :, :, :nbnd_sub, :nbnd_sub])
+            Ukq[:, :, :, :nbnd_sub], U[:, :, :, :nbnd_sub].conj(),
+            dfde, gq[:, :, :, :nbnd_sub, :nbnd_sub])
 
         if dd:
             indices = 'klam,klan,ac,xc->xklmn'
         else:
             indices = 'klam,klbn,abcd,xcd->xklmn'
 
-        my_g_[my_iq] = g[iq] + np.einsum(indices,
-            U[kq1, kq2].conj(), U[k1, k2], W[iq], Pig)
+        gq = gq + np.einsum(indices, Ukq.conj(), U, W[iq], Pig)
 
         #   k+q m           K+q M
         #  ___/___ a     c ___/___
@@ -609,9 +755,21 @@ def renormalize_coupling_band(q, e, g, W, U, kT=0.025, eps=1e-15,
         #     /    b     d    /
         #    k n             K N
 
+        if storage is None:
+            return gq
+
+        g_[iq] = gq
+
+    my_iq, my_g_ = MPI.parallel(renormalize, range(nQ), threads)
+
+    if storage is not None:
+        comm.Barrier()
+
+        return g_
+
     g_ = np.empty((nQ, nmodes, nk, nk, nbnd, nbnd), dtype=complex)
 
-    comm.Allgatherv(my_g_, (g_, sizes * nmodes * nk * nk * nbnd * nbnd))
+    MPI.collect(my_iq, my_g_, g_)
 
     return g_
 
@@ -686,7 +844,7 @@ def renormalize_coupling_orbital(q, e, g, W, U, **kwargs):
     return G
 
 def Pi_g(q, e, g, U, kT=0.025, eps=1e-15,
-        occupations=occupations.fermi_dirac, dd=True, status=True):
+        occupations=occupations.fermi_dirac, dd=True, status=True, threads=1):
     """Join electron-phonon coupling and Lindhard bubble in orbital basis.
 
     Parameters
@@ -710,6 +868,8 @@ def Pi_g(q, e, g, U, kT=0.025, eps=1e-15,
         Consider only density-density terms?
     status : bool
         Print status messages during the calculation?
+    threads : int
+        Number of threads per process working on different q points.
 
     Returns
     -------
@@ -725,39 +885,26 @@ def Pi_g(q, e, g, U, kT=0.025, eps=1e-15,
     f = occupations(x)
     d = occupations.delta(x) / (-kT)
 
-    e = np.tile(e, (2, 2, 1))
-    f = np.tile(f, (2, 2, 1))
-    U = np.tile(U, (2, 2, 1, 1))
-
     scale = nk / (2 * np.pi)
     prefactor = 2.0 / nk ** 2
 
-    sizes, bounds = MPI.distribute(nQ, bounds=True)
-
-    if dd:
-        my_Pig = np.empty((sizes[comm.rank], nmodes, norb), dtype=complex)
-    else:
-        my_Pig = np.empty((sizes[comm.rank], nmodes, norb, norb), dtype=complex)
-
-    dfde = np.empty((nk, nk, nbnd, nbnd))
-
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+    def calculate_Pi_g(iq):
         if status:
             print('Calculate "g Pi" for q point %d..' % (iq + 1))
 
         q1 = int(round(q[iq, 0] * scale)) % nk
         q2 = int(round(q[iq, 1] * scale)) % nk
 
-        k1 = slice(0, nk)
-        k2 = slice(0, nk)
+        ekq = shift(e, q1, q2)
+        fkq = shift(f, q1, q2)
+        Ukq = shift(U, q1, q2)
 
-        kq1 = slice(q1, q1 + nk)
-        kq2 = slice(q2, q2 + nk)
+        dfde = np.empty((nk, nk, nbnd, nbnd))
 
         for m in range(nbnd):
             for n in range(nbnd):
-                df = f[kq1, kq2, m] - f[k1, k2, n]
-                de = e[kq1, kq2, m] - e[k1, k2, n]
+                df = fkq[:, :, m] - f[:, :, n]
+                de = ekq[:, :, m] - e[:, :, n]
 
                 ok = abs(de) > eps
 
@@ -769,8 +916,8 @@ def Pi_g(q, e, g, U, kT=0.025, eps=1e-15,
         else:
             indices = 'klcm,kldn,klmn,klam,klbn,xklab->xcd'
 
-        my_Pig[my_iq] = prefactor * np.einsum(indices,
-            U[kq1, kq2], U[k1, k2].conj(), dfde, U[kq1, kq2].conj(), U[k1, k2],
+        return prefactor * np.einsum(indices,
+            Ukq, U.conj(), dfde, Ukq.conj(), U,
             g[iq])
 
         #     k+q m
@@ -781,17 +928,20 @@ def Pi_g(q, e, g, U, kT=0.025, eps=1e-15,
         #  d    /    b
         #      k n
 
+    my_iq, my_Pig = MPI.parallel(calculate_Pi_g, range(nQ), threads)
+
     if dd:
         Pig = np.empty((nQ, nmodes, norb), dtype=complex)
-        comm.Allgatherv(my_Pig, (Pig, sizes * nmodes * norb))
     else:
         Pig = np.empty((nQ, nmodes, norb, norb), dtype=complex)
-        comm.Allgatherv(my_Pig, (Pig, sizes * nmodes * norb * norb))
+
+    MPI.collect(my_iq, my_Pig, Pig)
 
     return Pig
 
 def double_fermi_surface_average(q, e, g2, kT=0.025,
-        occupations=occupations.fermi_dirac, comm=comm):
+        occupations=occupations.fermi_dirac, cutoff=None, threads=1,
+        comm=comm):
     """Calculate double Fermi-surface average.
 
     Parameters
@@ -801,12 +951,22 @@ def double_fermi_surface_average(q, e, g2, kT=0.025,
         [0, 2 \pi)`.
     e : ndarray
         Electron dispersion on uniform mesh. The Fermi level must be at zero.
-    g2 : ndarray
-        Quantity to be averaged, typically electron-phonon coupling.
+    g2 : ndarray or MPI.DiskArray
+        Quantity to be averaged, typically electron-phonon coupling. If stored
+        on disk, it is read q point by q point.
     kT : float
         Smearing temperature.
     occupations : function
         Particle distribution as a function of energy divided by `kT`.
+    cutoff : float, optional
+        Energy window around the Fermi level. Only states with energies below
+        `cutoff` in magnitude are considered, which are listed per band in
+        advance. Each neglected term contains a delta function at an argument
+        of at least ``cutoff / kT``, i.e., it is bounded by the fraction
+        ``occupations.delta(cutoff / kT) / occupations.delta(0)`` of the
+        largest term (about ``4 exp(-cutoff / kT)`` for Fermi-Dirac smearing).
+    threads : int
+        Number of threads per process working on different q points.
 
     Returns
     -------
@@ -818,42 +978,69 @@ def double_fermi_surface_average(q, e, g2, kT=0.025,
 
     d = occupations.delta(e / kT) / kT
 
-    e = np.tile(e, (2, 2, 1))
-    d = np.tile(d, (2, 2, 1))
-
     scale = nk / (2 * np.pi)
 
-    sizes, bounds = MPI.distribute(nQ, bounds=True, comm=comm)
+    if cutoff is not None:
+        window = abs(e) < cutoff
 
-    my_av = np.empty((sizes[comm.rank], nph), dtype=g2.dtype)
-    my_wg = np.empty(sizes[comm.rank])
+        K = [np.nonzero(window[:, :, n]) for n in range(nel)]
 
-    d2 = np.empty((nk, nk, nel, nel))
+    def average_window(iq):
+        q1 = int(round(q[iq, 0] * scale)) % nk
+        q2 = int(round(q[iq, 1] * scale)) % nk
+
+        g2_q = g2[iq]
+
+        av = np.zeros(nph, dtype=g2.dtype)
+        wg = 0.0
+
+        for n in range(nel):
+            k1, k2 = K[n]
+
+            kq1 = (k1 + q1) % nk
+            kq2 = (k2 + q2) % nk
+
+            for m in range(nel):
+                ok = window[kq1, kq2, m]
+
+                d2 = d[kq1[ok], kq2[ok], m] * d[k1[ok], k2[ok], n]
 
-    k1 = slice(0, nk)
-    k2 = slice(0, nk)
+                av += np.dot(g2_q[:, k1[ok], k2[ok], m, n], d2)
+                wg += d2.sum()
+
+        return av, wg
+
+    def average(iq):
+        if cutoff is not None:
+            return average_window(iq)
 
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
         q1 = int(round(q[iq, 0] * scale)) % nk
         q2 = int(round(q[iq, 1] * scale)) % nk
 
-        kq1 = slice(q1, q1 + nk)
-        kq2 = slice(q2, q2 + nk)
+        dkq = shift(d, q1, q2)
+
+        d2 = np.empty((nk, nk, nel, nel))
 
         for m in range(nel):
             for n in range(nel):
-                d2[:, :, m, n] = d[kq1, kq2, m] * d[k1, k2, n]
+                d2[:, :, m, n] = dkq[:, :, m] * d[:, :, n]
+
+        g2_q = g2[iq]
 
-        my_wg[my_iq] = d2.sum()
+        av = np.empty(nph, dtype=g2.dtype)
 
         for nu in range(nph):
-            my_av[my_iq, nu] = (g2[iq, nu] * d2).sum()
+            av[nu] = (g2_q[nu] * d2).sum()
+
+        return av, d2.sum()
+
+    my_iq, my_av = MPI.parallel(average, range(nQ), threads, comm)
 
     av = np.empty((nQ, nph), dtype=g2.dtype)
     wg = np.empty(nQ)
 
-    comm.Allgatherv(my_av, (av, sizes * nph))
-    comm.Allgatherv(my_wg, (wg, sizes))
+    MPI.collect(my_iq, [av_q for av_q, wg_q in my_av], av, comm=comm)
+    MPI.collect(my_iq, [wg_q for av_q, wg_q in my_av], wg, comm=comm)
 
     return av, wg
 
@@ -927,13 +1114,6 @@ def triangle(q1, q2, q3, e, g1, g2, g3, kT=0.025, eps=1e-14,
     f = occupations(x)
     d = occupations.delta(x) / kT
 
-    e  = np.tile(e,  (2, 2, 1))
-    f  = np.tile(f,  (2, 2, 1))
-    d  = np.tile(d,  (2, 2, 1))
-    g1 = np.tile(g1, (2, 2, 1, 1))
-    g2 = np.tile(g2, (2, 2, 1, 1))
-    g3 = np.tile(g3, (2, 2, 1, 1))
-
     scale = nk / (2 * np.pi)
     prefactor = 1.0 / nk ** 2
 
@@ -945,29 +1125,28 @@ def triangle(q1, q2, q3, e, g1, g2, g3, kT=0.025, eps=1e-14,
     q21 = int(round(q2[0] * scale)) % nk
     q22 = int(round(q2[1] * scale)) % nk
 
-    k1 = slice(0, nk)
-    k2 = slice(0, nk)
-
-    kq1 = slice(q11, q11 + nk)
-    kq2 = slice(q12, q12 + nk)
+    ekq = shift(e, q11, q12)
+    fkq = shift(f, q11, q12)
+    dkq = shift(d, q11, q12)
 
-    kQ1 = slice(q21, q21 + nk)
-    kQ2 = slice(q22, q22 + nk)
+    ekQ = shift(e, q21, q22)
+    fkQ = shift(f, q21, q22)
+    dkQ = shift(d, q21, q22)
 
     for a in range(nbnd):
-        ea = e[k1, k2, a]
-        fa = f[k1, k2, a]
-        da = d[k1, k2, a]
+        ea = e[:, :, a]
+        fa = f[:, :, a]
+        da = d[:, :, a]
 
         for b in range(nbnd):
-            eb = e[kq1, kq2, b]
-            fb = f[kq1, kq2, b]
-            db = d[kq1, kq2, b]
+            eb = ekq[:, :, b]
+            fb = fkq[:, :, b]
+            db = dkq[:, :, b]
 
             for c in range(nbnd):
-                ec = e[kQ1, kQ2, c]
-                fc = f[kQ1, kQ2, c]
-                dc = d[kQ1, kQ2, c]
+                ec = ekQ[:, :, c]
+                fc = fkQ[:, :, c]
+                dc = dkQ[:, :, c]
 
                 dea = eb - ec
                 deb = ec - ea
@@ -999,6 +1178,6 @@ def triangle(q1, q2, q3, e, g1, g2, g3, kT=0.025, eps=1e-14,
                 chi[a, b, c][l] = da[l] * (0.5 - fa[l])
 
     chi = np.einsum('abckl,klba,klca,klbc', chi,
-        g1[k1, k2].conj(), g2[k1, k2], g3[kQ1, kQ2])
+        g1.conj(), g2, shift(g3, q21, q22))
 
     return prefactor * chi.sum()
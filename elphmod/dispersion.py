@@ -10,14 +10,16 @@ from . import bravais, misc, MPI
 comm = MPI.comm
 
 def dispersion(matrix, k, angle=60, vectors=False, gauge=False, rotate=False,
-        order=False, hermitian=True, broadcast=True, shared_memory=False):
+        order=False, hermitian=True, broadcast=True, shared_memory=False,
+        chunk=1000):
     """Diagonalize Hamiltonian or dynamical matrix for given k points.
 
     Parameters
     ----------
     matrix : function
         Matrix to be diagonalized as a function of k in crystal coordinates with
-        period :math:`2 \pi`.
+        period :math:`2 \pi`. If a vectorized counterpart is found via
+        :func:`batched`, it is used to set up each chunk of matrices at once.
     k : list of 2-tuples
         k points in crystal coordinates with period :math:`2 \pi`.
     angle : float
@@ -39,6 +41,9 @@ def dispersion(matrix, k, angle=60, vectors=False, gauge=False, rotate=False,
         Broadcast result from rank 0 to all processes?
     shared_memory : bool
         Store results in shared memory?
+    chunk : int
+        Maximum number of matrices set up and diagonalized at once by each
+        processor. This limits the memory needed for the stacked matrices.
 
     Returns
     -------
@@ -76,58 +81,74 @@ def dispersion(matrix, k, angle=60, vectors=False, gauge=False, rotate=False,
 
     comm.Scatterv((k, my_points * dimens), my_k)
 
-    # diagonalize matrix for local lists of k points:
+    # diagonalize matrix for local lists of k points chunk by chunk:
 
-    status = misc.StatusBar(my_points[comm.rank], title='calculate dispersion')
+    chunks = range(0, len(my_k), chunk)
+
+    status = misc.StatusBar(len(chunks), title='calculate dispersion')
 
     if rotate:
         a1, a2 = bravais.translations(180 - angle)
         b1, b2 = bravais.reciprocals(a1, a2)
 
-    for point in range(len(my_k)):
-        matrix_k = matrix(*my_k[point])
+    batch = batched(matrix)
+
+    for lower in chunks:
+        points_k = slice(lower, min(lower + chunk, len(my_k)))
+
+        if batch is None:
+            matrix_k = np.array([matrix(*point) for point in my_k[points_k]])
+        else:
+            matrix_k = batch(my_k[points_k])
+
+        matrix_k = np.reshape(matrix_k, (-1, bands, bands))
 
         if order or vectors:
             if bands == 1:
-                my_v[point], my_V[point] = matrix_k.real, 1
+                my_v[points_k], my_V[points_k] = matrix_k[:, 0].real, 1
             elif hermitian:
-                my_v[point], my_V[point] = np.linalg.eigh(matrix_k)
+                my_v[points_k], my_V[points_k] = np.linalg.eigh(matrix_k)
             else:
-                tmp, my_V[point] = np.linalg.eig(matrix_k)
-                my_v[point] = tmp.real
+                w, V = np.linalg.eig(matrix_k)
 
-                tmp = np.argsort(my_v[point])
+                sort = np.argsort(w.real, axis=1)
 
-                my_v[point] = my_v[point][tmp]
-                my_V[point] = my_V[point][:, tmp]
+                my_v[points_k] = np.take_along_axis(w.real, sort, axis=1)
+                my_V[points_k] = np.take_along_axis(V, sort[:, np.newaxis],
+                    axis=2)
 
             if gauge:
-                for band in range(bands):
-                    my_V[point, :, band] *= np.exp(-1j * np.angle(
-                        max(my_V[point, :, band], key=abs)))
+                V = my_V[points_k]
+
+                largest = np.take_along_axis(V,
+                    np.argmax(abs(V), axis=1)[:, np.newaxis, :], axis=1)
+
+                V *= np.exp(-1j * np.angle(largest))
 
             # rotate phonon eigenvectors by negative angle of k point:
 
             if rotate:
-                k1, k2 = bravais.to_Voronoi(*my_k[point, :2], nk=2 * np.pi,
-                    angle=angle)[0]
+                for point in range(points_k.start, points_k.stop):
+                    k1, k2 = bravais.to_Voronoi(*my_k[point, :2],
+                        nk=2 * np.pi, angle=angle)[0]
 
-                x, y = k1 * b1 + k2 * b2
-                phi = np.arctan2(y, x)
+                    x, y = k1 * b1 + k2 * b2
+                    phi = np.arctan2(y, x)
 
-                atoms = bands // 3
+                    atoms = bands // 3
 
-                for atom in range(atoms):
-                    for band in range(bands):
-                        xy = point, [atom, atom + atoms], band
-                        my_V[xy] = bravais.rotate(my_V[xy], -phi)
+                    for atom in range(atoms):
+                        for band in range(bands):
+                            xy = point, [atom, atom + atoms], band
+                            my_V[xy] = bravais.rotate(my_V[xy], -phi)
         else:
             if bands == 1:
-                my_v[point] = matrix_k.real
+                my_v[points_k] = matrix_k[:, 0].real
             elif hermitian:
-                my_v[point] = np.linalg.eigvalsh(matrix_k)
+                my_v[points_k] = np.linalg.eigvalsh(matrix_k)
             else:
-                my_v[point] = np.linalg.eigvals(matrix_k).real.sort()
+                my_v[points_k] = np.sort(np.linalg.eigvals(matrix_k).real,
+                    axis=1)
 
         status.update()
 
@@ -186,10 +207,128 @@ def dispersion(matrix, k, angle=60, vectors=False, gauge=False, rotate=False,
 
     return v
 
+def batched(matrix):
+    """Find vectorized counterpart of matrix-valued function.
+
+    For a method ``X`` of some object, this is the method ``X_batch`` of the
+    same object, if present. It takes an array of k points (one per row) and
+    returns the corresponding matrices stacked along the first axis.
+
+    Parameters
+    ----------
+    matrix : function
+        Matrix as a function of k, e.g., :meth:`el.Model.H`.
+
+    Returns
+    -------
+    function or None
+        Vectorized counterpart, e.g., :meth:`el.Model.H_batch`, if any.
+    """
+    return counterpart(matrix, '_batch')
+
+def meshed(matrix):
+    """Find uniform-mesh counterpart of matrix-valued function.
+
+    For a method ``X`` of some object, this is the method ``X_mesh`` of the
+    same object, if present. It takes the number of mesh points per dimension
+    and returns the corresponding matrices on the whole mesh, typically
+    calculated via FFT. Plain functions can provide such a counterpart as their
+    attribute ``mesh``, e.g., :func:`diagrams.susceptibility2`.
+
+    Parameters
+    ----------
+    matrix : function
+        Matrix as a function of k, e.g., :meth:`el.Model.H`.
+
+    Returns
+    -------
+    function or None
+        Uniform-mesh counterpart, e.g., :meth:`el.Model.H_mesh`, if any.
+    """
+    return counterpart(matrix, '_mesh')
+
+def counterpart(matrix, suffix):
+    """Find method of same object with name extended by given suffix.
+
+    For plain functions, look for an attribute named like the suffix instead.
+    """
+    owner = getattr(matrix, '__self__', None)
+    name = getattr(matrix, '__name__', None)
+
+    if owner is None or name is None:
+        return getattr(matrix, suffix.lstrip('_'), None)
+
+    return getattr(owner, name + suffix, None)
+
+def on_mesh(matrix, size, shared_memory=False):
+    """Prepare matrix-valued function for evaluation on uniform mesh.
+
+    If a counterpart is found via :func:`meshed`, the matrices on the whole
+    mesh are calculated once by the first processor and broadcast. The returned
+    function merely looks them up. Otherwise, `matrix` is returned unchanged.
+
+    Note that all matrices on the mesh are stored on each processor (or node if
+    `shared_memory` is set), and that the first processor additionally holds
+    the temporary arrays of the FFT. For large meshes or many bands, this can
+    exceed the available memory.
+
+    Parameters
+    ----------
+    matrix : function
+        Matrix as a function of k in crystal coordinates with period
+        :math:`2 \pi`.
+    size : int
+        Number of k points per dimension.
+    shared_memory : bool
+        Store matrices on mesh in shared memory?
+
+    Returns
+    -------
+    function
+        Matrix as a function of k, defined at least on the mesh points.
+    """
+    mesh = meshed(matrix)
+
+    if mesh is None:
+        return matrix
+
+    template = matrix()
+
+    node, images, matrices = MPI.shared_array((size, size) + template.shape,
+        dtype=template.dtype, shared_memory=shared_memory)
+
+    if comm.rank == 0:
+        matrices[...] = mesh(size)
+
+    if node.rank == 0:
+        images.Bcast(matrices)
+
+    comm.Barrier()
+
+    scale = size / (2 * np.pi)
+
+    def matrix_on_mesh(k1=0, k2=0, k3=0):
+        return matrices[
+            int(round(k1 * scale)) % size,
+            int(round(k2 * scale)) % size]
+
+    return matrix_on_mesh
+
 def dispersion_full(matrix, size, angle=60, vectors=False, gauge=False,
         rotate=False, order=False, hermitian=True, broadcast=True,
-        shared_memory=False):
-    """Diagonalize Hamiltonian or dynamical matrix on uniform k-point mesh."""
+        shared_memory=False, fft=False):
+    """Diagonalize Hamiltonian or dynamical matrix on uniform k-point mesh.
+
+    With ``fft=True``, the matrices are set up on the whole mesh at once via
+    FFT, if available. Otherwise, they are set up for the irreducible k points
+    only, distributed among all processors.
+
+    See Also
+    --------
+    on_mesh
+    """
+    if fft:
+        matrix = on_mesh(matrix, size, shared_memory=shared_memory)
 
     # choose irreducible set of k points:
 
@@ -331,8 +470,16 @@ def dispersion_full_nosym(matrix, size, *args, **kwargs):
 
     Use this routine to get eigenvectors less symmetric than the eigenvalues!
 
+    With ``fft=True``, the matrices are set up on the whole mesh at once via
+    FFT, if available. Otherwise, they are set up for the required k points
+    only, distributed among all processors.
+
     To do: The reshape part fails if :func:`dispersion` returns a scalar."""
 
+    if kwargs.pop('fft', False):
+        matrix = on_mesh(matrix, size,
+            shared_memory=kwargs.get('shared_memory', False))
+
     if comm.rank == 0:
         k = np.empty((size * size, 2))
 
@@ -359,7 +506,8 @@ def sample(matrix, k):
     Parameters
     ----------
     matrix : function
-        Matrix as a function of k.
+        Matrix as a function of k. If a vectorized counterpart is found via
+        :func:`batched`, it is used to set up all local matrices at once.
     k : list of tuples
         k points.
     """
@@ -370,8 +518,14 @@ def sample(matrix, k):
     my_matrix = np.empty((sizes[comm.rank],) + template.shape,
         dtype=template.dtype)
 
-    for my_ik, ik in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
-        my_matrix[my_ik] = matrix(*k[ik])
+    batch = batched(matrix)
+
+    if batch is not None:
+        my_matrix[...] = batch(np.array(k)[bounds[comm.rank]:
+            bounds[comm.rank + 1]])
+    else:
+        for my_ik, ik in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+            my_matrix[my_ik] = matrix(*k[ik])
 
     matrix = np.empty((len(k),) + template.shape, dtype=template.dtype)
 
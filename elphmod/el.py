@@ -5,7 +5,7 @@
 
 import numpy as np
 
-from . import dispersion, misc, MPI
+from . import bravais, dispersion, misc, MPI
 comm = MPI.comm
 
 class Model(object):
@@ -15,6 +15,8 @@ class Model(object):
     ----------
     hrdat : str
         File with Hamiltonian in Wannier basis from Wannier90.
+    cache : bool
+        Cache parsed Hamiltonian in binary file? See :func:`read_hrdat`.
 
     Attributes
     ----------
@@ -28,11 +30,36 @@ class Model(object):
     def H(self, k1=0, k2=0, k3=0):
         """Set up Hamilton operator for arbitrary k point."""
 
-        k = np.array([k1, k2, k3])
-        H = np.empty(self.data.shape, dtype=complex)
+        return self.H_batch([[k1, k2, k3]])[0]
 
-        for n in range(H.shape[0]):
-            H[n] = self.data[n] * np.exp(1j * np.dot(self.R[n], k))
+    def H_batch(self, k, chunk=1000):
+        r"""Set up Hamilton operators for many k points at once.
+
+        Parameters
+        ----------
+        k : ndarray
+            k points in crystal coordinates with period :math:`2 \pi`, one per
+            row. Missing trailing coordinates are treated as zero.
+        chunk : int
+            Maximum number of k points processed in one matrix product. This
+            limits the memory needed for the intermediate phase factors.
+
+        Returns
+        -------
+        ndarray
+            Hamiltonians stacked along the first axis.
+        """
+        k = np.array(k, dtype=float, ndmin=2)
+
+        R = self.R[:, :k.shape[1]]
+        data = np.reshape(self.data, (len(self.R), -1))
+
+        H = np.empty((len(k), self.size, self.size), dtype=complex)
+
+        for lower in range(0, len(k), chunk):
+            upper = min(lower + chunk, len(k))
+
+            phase = np.exp(1j * np.dot(k[lower:upper], R.T))
 
             # Sign convention in hamiltonian.f90 of Wannier90:
             # 295  fac=exp(-cmplx_i*rdotk)/real(num_kpts,dp)
@@ -44,62 +71,125 @@ class Model(object):
             # Compare this convention [doi:10.26092/elib/250, Eq. 2.35a]:
             # t(R - R', a, b) = <R a|H|R' b> = <R' b|H|R a>
 
-        return H.sum(axis=0)
+            H[lower:upper] = np.reshape(np.dot(phase, data),
+                (upper - lower, self.size, self.size))
+
+        return H
+
+    def H_mesh(self, nk1, nk2=None, nk3=None):
+        """Set up Hamilton operators on uniform k mesh via FFT.
+
+        Parameters
+        ----------
+        nk1, nk2, nk3 : int
+            Number of k points per dimension. `nk2` defaults to `nk1`. If `nk3`
+            is omitted, only the plane :math:`k_3 = 0` is considered and the
+            corresponding axis is dropped.
+
+        Returns
+        -------
+        ndarray
+            Hamiltonians on mesh. ``H_mesh(nk)[K1, K2]`` equals
+            ``H(2 * np.pi * K1 / nk, 2 * np.pi * K2 / nk)``.
+        """
+        nk = (nk1, nk1 if nk2 is None else nk2)
 
-    def __init__(self, hrdat):
-        self.R, self.data = read_hrdat(hrdat)
+        if nk3 is not None:
+            nk += (nk3,)
+
+        return bravais.Fourier_mesh(self.R, self.data, nk, sign=+1)
+
+    def __init__(self, hrdat, cache=False):
+        self.R, self.data = read_hrdat(hrdat, cache)
         self.size = self.data.shape[1]
 
-def read_hrdat(hrdat):
-    """Read *_hr.dat* file from Wannier90."""
+def read_hrdat(hrdat, cache=False):
+    """Read *_hr.dat* file from Wannier90.
+
+    Parameters
+    ----------
+    hrdat : str
+        File with Hamiltonian in Wannier basis from Wannier90.
+    cache : bool
+        Store parsed data in binary file *hrdat.npz* and read it from there as
+        long as `hrdat` is unchanged?
 
+    Returns
+    -------
+    ndarray
+        Lattice vectors of Wigner-Seitz supercell.
+    ndarray
+        Corresponding onsite energies and hoppings divided by degeneracies.
+
+    See Also
+    --------
+    misc.load_cache, misc.save_cache
+    """
     if comm.rank == 0:
-        data = open(hrdat)
+        cached = misc.load_cache(hrdat) if cache else None
 
-        # read all words of current line:
+        if cached is None:
+            with open(hrdat) as data:
+                # read all words of current line:
 
-        def cols():
-            return data.readline().split()
+                def cols():
+                    return data.readline().split()
 
-        # skip header:
+                # skip header:
 
-        date = cols()[2]
+                date = cols()[2]
 
-        # get dimensions:
+                # get dimensions:
 
-        num_wann = int(cols()[0])
-        nrpts = int(cols()[0])
+                num_wann = int(cols()[0])
+                nrpts = int(cols()[0])
 
-        # read degeneracies of Wigner-Seitz grid points:
+                # read degeneracies of Wigner-Seitz grid points:
 
-        degeneracy = []
+                degeneracy = []
 
-        while len(degeneracy) < nrpts:
-            degeneracy.extend(map(float, cols()))
-    else:
-        num_wann = nrpts = None
+                while len(degeneracy) < nrpts:
+                    degeneracy.extend(map(float, cols()))
 
-    num_wann = comm.bcast(num_wann)
-    nrpts = comm.bcast(nrpts)
+                degeneracy = np.array(degeneracy)
 
-    cells = np.empty((nrpts, 3), dtype=int)
-    const = np.empty((nrpts, num_wann, num_wann), dtype=complex)
+                # read lattice vectors and hopping constants block by block
+                # into preallocated arrays (without intermediate strings):
 
-    if comm.rank == 0:
-        # read lattice vectors and hopping constants:
+                size = num_wann ** 2
 
-        size = num_wann ** 2
+                cells = np.empty((nrpts, 3), dtype=int)
+                const = np.empty((nrpts, num_wann, num_wann), dtype=complex)
 
-        for n in range(nrpts):
-            for _ in range(size):
-                tmp = cols()
+                for n in range(nrpts):
+                    table = np.fromfile(data, sep=' ', count=size * 7)
+                    table = np.reshape(table, (size, 7))
 
-                const[n, int(tmp[3]) - 1, int(tmp[4]) - 1] = (
-                    float(tmp[5]) + 1j * float(tmp[6])) / degeneracy[n]
+                    a = table[:, 3].astype(int) - 1
+                    b = table[:, 4].astype(int) - 1
 
-            cells[n] = list(map(int, tmp[:3]))
+                    const[n, a, b] = table[:, 5] + 1j * table[:, 6]
+                    const[n] /= degeneracy[n]
 
-        data.close()
+                    cells[n] = table[0, :3]
+
+            if cache:
+                misc.save_cache(hrdat, dict(cells=cells, degeneracy=degeneracy,
+                    const=const))
+        else:
+            cells = cached['cells']
+            const = cached['const']
+
+        nrpts, num_wann = const.shape[:2]
+    else:
+        num_wann = nrpts = None
+
+    num_wann = comm.bcast(num_wann)
+    nrpts = comm.bcast(nrpts)
+
+    if comm.rank != 0:
+        cells = np.empty((nrpts, 3), dtype=int)
+        const = np.empty((nrpts, num_wann, num_wann), dtype=complex)
 
     comm.Bcast(cells)
     comm.Bcast(const)
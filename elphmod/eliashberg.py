@@ -50,13 +50,18 @@ def McMillan(nq, e, w2, g2, eps=1e-10, mustar=0.0):
     g2dd = np.zeros((nQ, nph))
     dd   = np.zeros(nQ)
 
+    # only bands crossing the Fermi level contribute to tetrahedron integrals:
+
+    crossing = [n for n in range(nel)
+        if e[:, :, n].min() <= 0 <= e[:, :, n].max()]
+
     for iq, (q1, q2) in enumerate(q):
         E = np.roll(np.roll(e, shift=-q1, axis=0), shift=-q2, axis=1)
 
         g2_fun = bravais.linear_interpolation(g2[iq], axes=(1, 2))
 
-        for n in range(nel):
-            for m in range(nel):
+        for n in crossing:
+            for m in crossing:
                 intersections = dos.double_delta(e[:, :, n], E[:, :, m])(0)
 
                 for (k1, k2), weight in intersections.items():
@@ -65,7 +70,7 @@ def McMillan(nq, e, w2, g2, eps=1e-10, mustar=0.0):
 
     N0 = 0
 
-    for n in range(nel):
+    for n in crossing:
         N0 += dos.hexDOS(e[:, :, n])(0)
 
     w2 = w2.copy()
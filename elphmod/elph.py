@@ -6,9 +6,10 @@
 # Some routines in this file follow wan2bloch.f90 of EPW v5.3.1.
 # Copyright (C) 2010-2016 S. Ponce', R. Margine, C. Verdi, F. Giustino
 
+import collections
 import numpy as np
 
-from . import bravais, dispersion, el, misc, MPI, ph
+from . import bravais, diagrams, dispersion, el, misc, MPI, ph
 comm = MPI.comm
 
 class Model(object):
@@ -30,6 +31,16 @@ class Model(object):
         Divide electron-phonon coupling by square root of atomic masses?
     shared_memory : bool
         Read coupling from EPW into shared memory?
+    memmap : bool
+        Memory-map coupling from EPW instead of reading it? In this case, the
+        division by degeneracies and masses is done on the fly for each block
+        of data belonging to a given Rg vector.
+    cache : float
+        Memory budget in GB for the Rk-dependent couplings of previously
+        sampled q points, which are kept for reuse in least-recently-used
+        order. The coupling for the last q point is always kept, which is all
+        that is needed if each q point is visited only once, e.g., by
+        :func:`sample`. Increase the budget if q points are revisited.
 
     Attributes
     ----------
@@ -38,11 +49,22 @@ class Model(object):
     Rk, Rg : ndarray
         Lattice vectors of Wigner-Seitz supercells.
     data : ndarray
-        Corresponding electron-phonon matrix elements.
+        Corresponding electron-phonon matrix elements. If memory-mapped, the
+        division by degeneracies and masses has not been applied yet.
+    wk, wg : ndarray
+        Inverse degeneracies (and masses) to be applied to blocks of memory-
+        mapped data on the fly, if any.
     q : ndarray
         Previously sampled q point, if any.
     gq : ndarray
         Rk-dependent coupling for above q point for possible reuse.
+    cached : OrderedDict
+        Rk-dependent couplings for recently sampled q points, ordered from
+        least to most recently used.
+    capacity : int
+        Maximum number of q points in above cache.
+    hits, misses : int
+        Number of requested q points found or not found in above cache.
     """
     def g(self, q1=0, q2=0, q3=0, k1=0, k2=0, k3=0, elbnd=False, phbnd=False,
             broadcast=True, comm=comm):
@@ -57,10 +79,13 @@ class Model(object):
 
         Parameters
         ----------
-        q1, q2, q2 : float
+        q1, q2, q3 : float or ndarray
             q point in crystal coordinates with period :math:`2 \pi`.
-        k1, k2, k3 : float
+        k1, k2, k3 : float or ndarray
             Ingoing k point in crystal coordinates with period :math:`2 \pi`.
+            If any of the coordinates of q or k are arrays, they are broadcast
+            against each other and the coupling is calculated for all pairs of
+            q and k points at once.
         elbnd : bool
             Transform to electronic band basis? Provided for convenience. Since
             the Hamiltonian is diagonalized on the fly for each requested matrix
@@ -82,50 +107,52 @@ class Model(object):
         -------
         ndarray
             Electron-phonon matrix element :math:`\sqrt{2 \omega} g_{\nu m n}`
-            in Ry\ :sup:`3/2`.
+            in Ry\ :sup:`3/2`. For arrays of q or k points, their broadcast
+            shape is prepended.
         """
 
         nRq, nph, nRk, nel, nel = self.data.shape
 
-        q = np.array([q1, q2, q3])
-        k = np.array([k1, k2, k3])
+        qk = np.broadcast_arrays(q1, q2, q3, k1, k2, k3)
+        shape = qk[0].shape
 
-        if comm.allreduce(self.q is None or np.any(q != self.q)):
-            self.q = q
+        q = np.reshape(np.stack(qk[:3], axis=-1), (-1, 3)).astype(float)
+        k = np.reshape(np.stack(qk[3:], axis=-1), (-1, 3)).astype(float)
 
-            sizes, bounds = MPI.distribute(nRq, bounds=True, comm=comm)
+        sizes, bounds = MPI.distribute(nRk, bounds=True, comm=comm)
 
-            my_g = np.empty((sizes[comm.rank], nph, nRk, nel, nel),
-                dtype=complex)
+        Rk = self.Rk[bounds[comm.rank]:bounds[comm.rank + 1]]
 
-            for my_n, n in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
-                my_g[my_n] = self.data[n] * np.exp(1j * np.dot(self.Rg[n], q))
+        my_g = np.empty((len(k), nph, nel, nel), dtype=complex)
 
-                # Sign convention in bloch2wan.f90 of EPW:
-                # 1222  cfac = EXP(-ci * rdotk) / DBLE(nq)
-                # 1223  epmatwp(:, :, :, :, ir) = epmatwp(:, :, :, :, ir)
-                #           + cfac * epmatwe(:, :, :, :, iq)
+        # Fourier transform from Rg to q once per distinct q point:
 
-            comm.Allreduce(my_g.sum(axis=0), self.gq)
+        Q, iQ = np.unique(q, axis=0, return_inverse=True)
 
-        sizes, bounds = MPI.distribute(nRk, bounds=True, comm=comm)
+        iQ = np.ravel(iQ)
 
-        my_g = np.empty((sizes[comm.rank], nph, nel, nel), dtype=complex)
+        for n in range(len(Q)):
+            self.transform_q(Q[n], comm=comm)
 
-        for my_n, n in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
-            my_g[my_n] = self.gq[:, n] * np.exp(1j * np.dot(self.Rk[n], k))
+            selected = np.where(iQ == n)[0]
+
+            phase = np.exp(1j * np.dot(k[selected], Rk.T))
 
             # Sign convention in bloch2wan.f90 of EPW:
             # 1120  cfac = EXP(-ci * rdotk) / DBLE(nkstot)
             # 1121  epmatw( :, :, ir) = epmatw( :, :, ir)
             #           + cfac * epmats(:, :, ik)
 
+            my_g[selected] = np.tensordot(phase,
+                self.gq[:, bounds[comm.rank]:bounds[comm.rank + 1]],
+                axes=(1, 1))
+
         if broadcast or comm.rank == 0:
-            g = np.empty((nph, nel, nel), dtype=complex)
+            g = np.empty((len(k), nph, nel, nel), dtype=complex)
         else:
             g = None
 
-        comm.Reduce(my_g.sum(axis=0), g)
+        comm.Reduce(my_g, g)
 
         if comm.rank == 0:
             # Eigenvector convention in wan2bloch.f90 of EPW:
@@ -141,23 +168,287 @@ class Model(object):
             # 2101       nbnd, cufkk, nbnd, czero, epmatf(:, :, imode), nbnd)
 
             if elbnd:
-                Uk  = np.linalg.eigh(self.el.H(*k))[1]
-                Ukq = np.linalg.eigh(self.el.H(*k + q))[1]
+                Uk  = np.linalg.eigh(self.el.H_batch(k))[1]
+                Ukq = np.linalg.eigh(self.el.H_batch(k + q))[1]
 
-                g = np.einsum('am,xab,bn->xmn', Ukq.conj(), g, Uk)
+                g = np.einsum('iam,ixab,ibn->ixmn', Ukq.conj(), g, Uk,
+                    optimize=True)
 
             if phbnd:
-                uq = np.linalg.eigh(self.ph.D(*q))[1]
+                uq = np.linalg.eigh(self.ph.D_batch(q))[1]
 
-                g = np.einsum('xab,xu->uab', g, uq)
+                g = np.einsum('ixab,ixu->iuab', g, uq)
+
+            g = np.reshape(g, shape + g.shape[1:])
 
         if broadcast:
+            if comm.rank != 0:
+                g = np.empty(shape + (nph, nel, nel), dtype=complex)
+
             comm.Bcast(g)
 
         return g
 
+    def g_mesh(self, nk, q1=0, q2=0, q3=0, broadcast=True, comm=comm):
+        r"""Calculate electron-phonon coupling for all k on uniform mesh via FFT.
+
+        Parameters
+        ----------
+        nk : int
+            Number of k points per dimension.
+        q1, q2, q3 : float
+            q point in crystal coordinates with period :math:`2 \pi`.
+        broadcast : bool
+            Broadcast result to all processors? If ``False``, returns ``None``
+            on all but the first processor.
+        comm : MPI communicator
+            Group of processors running this function (for parallelization of
+            Fourier transforms).
+
+        Returns
+        -------
+        ndarray
+            Electron-phonon matrix elements :math:`\sqrt{2 \omega} g_{\nu m n}`
+            in Ry\ :sup:`3/2` with the k-point indices :math:`k_i = 2 \pi K_i /
+            n_k` inserted after the mode index.
+
+        See Also
+        --------
+        g
+        """
+        nRq, nph, nRk, nel, nel = self.data.shape
+
+        self.transform_q(np.array([q1, q2, q3]), comm=comm)
+
+        # FFT from Rk to k mesh distributed over displacement directions:
+
+        sizes, bounds = MPI.distribute(nph, bounds=True, comm=comm)
+
+        my_gq = np.moveaxis(self.gq[bounds[comm.rank]:bounds[comm.rank + 1]],
+            1, 0)
+
+        my_g = np.moveaxis(bravais.Fourier_mesh(self.Rk, my_gq, (nk, nk),
+            sign=+1), 2, 0).copy()
+
+        if broadcast or comm.rank == 0:
+            g = np.empty((nph, nk, nk, nel, nel), dtype=complex)
+        else:
+            g = None
+
+        comm.Gatherv(my_g, (g, sizes * nk * nk * nel * nel))
+
+        if broadcast:
+            comm.Bcast(g)
+
+        return g
+
+    def g2(self, q, k, elbnd=True, phbnd=True, chunk=None, broadcast=True,
+            comm=comm):
+        r"""Calculate squared electron-phonon coupling for lists of q and k.
+
+        Parameters
+        ----------
+        q, k : ndarray
+            Pairs of q points and ingoing k points in crystal coordinates with
+            period :math:`2 \pi`, one per row. Missing trailing coordinates
+            are treated as zero.
+        elbnd : bool
+            Transform to electronic band basis?
+        phbnd : bool
+            Transform to phononic band basis?
+        chunk : int, optional
+            Maximum number of k points per work item. Defaults to a quarter of
+            the number of points per processor.
+        broadcast : bool
+            Broadcast result to all processors? If ``False``, returns ``None``
+            on all but the first processor.
+        comm : MPI communicator
+            Group of processors running this function (for parallelization over
+            the pairs of q and k points).
+
+        Returns
+        -------
+        ndarray
+            Squared electron-phonon matrix elements :math:`2 \omega |g_{\nu m
+            n}|^2` in Ry\ :sup:`3` for all pairs of q and k points, e.g., the
+            Fermi-surface points from :func:`dos.isoline` or the intersection
+            points from :func:`dos.double_delta`.
+
+        Notes
+        -----
+        In contrast to :meth:`g` with `elbnd` or `phbnd`, the Hamiltonian and
+        the dynamical matrix are diagonalized only once per distinct k, k + q,
+        and q point, respectively. The k points belonging to each distinct q
+        point are split into chunks, which are handed out to the processors on
+        demand, so that the work is balanced even if there is only a single q
+        point. For each chunk, the Fourier transform from Rk to k is done for
+        all k points at once. The Fourier transform from Rg to q is repeated
+        whenever a processor moves on to a chunk of another q point, unless
+        the couplings for several q points are cached (see `cache`).
+
+        See Also
+        --------
+        g
+        """
+        nRq, nph, nRk, nel, nel = self.data.shape
+
+        q = np.array(q, dtype=float, ndmin=2)
+        k = np.array(k, dtype=float, ndmin=2)
+
+        points = len(q)
+
+        q = np.pad(q, ((0, 0), (0, 3 - q.shape[1])))
+        k = np.pad(k, ((0, 0), (0, 3 - k.shape[1])))
+
+        if elbnd:
+            K, iK = np.unique(np.concatenate((k, k + q)), axis=0,
+                return_inverse=True)
+
+            iK = np.ravel(iK)
+
+            sizes, bounds = MPI.distribute(len(K), bounds=True, comm=comm)
+
+            my_U = np.linalg.eigh(self.el.H_batch(
+                K[bounds[comm.rank]:bounds[comm.rank + 1]]))[1]
+
+            U = np.empty((len(K), nel, nel), dtype=complex)
+
+            comm.Allgatherv(my_U, (U, sizes * nel * nel))
+
+            Uk = U[iK[:points]]
+            Ukq = U[iK[points:]]
+
+        Q, iQ = np.unique(q, axis=0, return_inverse=True)
+
+        iQ = np.ravel(iQ)
+
+        if phbnd:
+            sizes, bounds = MPI.distribute(len(Q), bounds=True, comm=comm)
+
+            my_u = np.linalg.eigh(self.ph.D_batch(
+                Q[bounds[comm.rank]:bounds[comm.rank + 1]]))[1]
+
+            u = np.empty((len(Q), nph, nph), dtype=complex)
+
+            comm.Allgatherv(my_u, (u, sizes * nph * nph))
+
+        # split k points belonging to same q point into chunks:
+
+        if chunk is None:
+            chunk = max(1, -(-points // (4 * comm.size)))
+
+        order = np.argsort(iQ, kind='stable')
+        order = np.split(order, np.cumsum(np.bincount(iQ))[:-1])
+
+        chunks = [selected[lower:lower + chunk]
+            for selected in order
+            for lower in range(0, len(selected), chunk)]
+
+        my_g2 = np.zeros((points, nph, nel, nel))
+
+        for selected in MPI.dynamic(chunks, comm=comm):
+            n = iQ[selected[0]]
+
+            g = self.g(Q[n, 0], Q[n, 1], Q[n, 2], k[selected, 0],
+                k[selected, 1], k[selected, 2], comm=MPI.single)
+
+            if elbnd:
+                g = np.matmul(np.matmul(
+                    Ukq[selected, np.newaxis].conj().swapaxes(-2, -1), g),
+                    Uk[selected, np.newaxis])
+
+            if phbnd:
+                g = np.einsum('ixab,xu->iuab', g, u[n])
+
+            my_g2[selected] = abs(g) ** 2
+
+        if broadcast or comm.rank == 0:
+            g2 = np.empty((points, nph, nel, nel))
+        else:
+            g2 = None
+
+        comm.Reduce(my_g2, g2)
+
+        if broadcast:
+            comm.Bcast(g2)
+
+        return g2
+
+    def transform_q(self, q, comm=comm):
+        """Fourier-transform coupling from Rg to q, unless already done.
+
+        Parameters
+        ----------
+        q : ndarray
+            q point in crystal coordinates with period :math:`2 \pi`.
+        comm : MPI communicator
+            Group of processors running this function (for parallelization of
+            Fourier transforms).
+
+        Returns
+        -------
+        ndarray
+            Rk-dependent coupling for given q point, also stored as `gq`.
+        """
+        nRq, nph, nRk, nel, nel = self.data.shape
+
+        key = tuple(np.asarray(q, dtype=float))
+
+        if comm.allreduce(key not in self.cached):
+            self.misses += 1
+
+            sizes, bounds = MPI.distribute(nRq, bounds=True, comm=comm)
+
+            my_g = np.empty((sizes[comm.rank], nph, nRk, nel, nel),
+                dtype=complex)
+
+            for my_n, n in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+                my_g[my_n] = self.block(n) * np.exp(1j * np.dot(self.Rg[n], q))
+
+                # Sign convention in bloch2wan.f90 of EPW:
+                # 1222  cfac = EXP(-ci * rdotk) / DBLE(nq)
+                # 1223  epmatwp(:, :, :, :, ir) = epmatwp(:, :, :, :, ir)
+                #           + cfac * epmatwe(:, :, :, :, iq)
+
+            gq = np.empty((nph, nRk, nel, nel), dtype=complex)
+
+            comm.Allreduce(my_g.sum(axis=0), gq)
+
+            self.cached[key] = gq
+
+            while len(self.cached) > self.capacity:
+                self.cached.popitem(last=False)
+        else:
+            self.hits += 1
+
+            self.cached[key] = self.cached.pop(key) # most recently used
+
+        self.q = q
+        self.gq = self.cached[key]
+
+        return self.gq
+
+    def block(self, irg):
+        """Get coupling for single Rg vector.
+
+        Parameters
+        ----------
+        irg : int
+            Index of Rg vector.
+
+        Returns
+        -------
+        ndarray
+            Corresponding electron-phonon matrix elements, where memory-mapped
+            data is divided by degeneracies and masses on the fly.
+        """
+        if self.wg is None:
+            return self.data[irg]
+
+        return self.data[irg] * self.wg[irg, :, np.newaxis] * self.wk
+
     def __init__(self, epmatwp, wigner, el, ph, old_ws=False, divide_mass=True,
-            shared_memory=False):
+            shared_memory=False, memmap=False, cache=0.0):
 
         self.el = el
         self.ph = ph
@@ -167,11 +458,61 @@ class Model(object):
         self.Rk, ndegen_k, self.Rg, ndegen_g = bravais.read_wigner_file(wigner,
             old_ws=old_ws, nat=ph.nat)
 
+        self.q = None
+        self.gq = None
+
+        self.cached = collections.OrderedDict()
+        self.capacity = max(1, int(cache * 1e9
+            / (16 * ph.size * len(self.Rk) * el.size ** 2)))
+
+        self.hits = 0
+        self.misses = 0
+
+        # prepare factors to undo supercell double counting and to divide by
+        # square root of atomic masses for Rk (irk, m, n) and Rg (irg, x, m, n):
+
+        def inverse(ndegen):
+            weight = np.zeros(ndegen.shape)
+            weight[ndegen != 0] = 1.0 / ndegen[ndegen != 0]
+            return weight
+
+        atom = np.repeat(np.arange(ph.nat), 3)
+
+        if old_ws:
+            wk = inverse(ndegen_k)[:, None, None]
+        elif ndegen_k.size == len(self.Rk):
+            wk = inverse(np.reshape(ndegen_k, (-1, 1, 1)))
+        else: # "use_ws"
+            wk = inverse(np.transpose(ndegen_k, (2, 1, 0)))
+
+        if old_ws:
+            wg = inverse(ndegen_g)[atom].T[:, :, None, None]
+        elif ndegen_g.size == len(self.Rg):
+            wg = inverse(np.reshape(ndegen_g, (-1, 1, 1, 1)))
+        else: # "use_ws"
+            wg = inverse(np.transpose(ndegen_g, (3, 2, 1, 0)))[:, atom]
+
+        if divide_mass:
+            wg = wg / np.sqrt(ph.M[atom])[:, None, None]
+
         # read coupling in Wannier basis from EPW output:
         # ('epmatwp' allocated and printed in 'ephwann_shuffle.f90')
 
         shape = len(self.Rg), ph.size, len(self.Rk), el.size, el.size
 
+        if memmap:
+            # map file without reading and swap orbitals of lazy view:
+
+            self.data = np.swapaxes(np.memmap(epmatwp, dtype=np.complex128,
+                mode='r', shape=shape), 3, 4)
+
+            self.wk = wk
+            self.wg = wg
+
+            return
+
+        self.wk = self.wg = None
+
         node, images, g = MPI.shared_array(shape, dtype=np.complex128,
             shared_memory=shared_memory)
 
@@ -183,62 +524,14 @@ class Model(object):
                     tmp = np.fromfile(data, dtype=np.complex128,
                         count=np.prod(shape[1:])).reshape(shape[1:])
 
-                    g[irg] = np.swapaxes(tmp, 2, 3)
-
                     # index orders:
                     # EPW (Fortran): a, b, R', x, R
                     # after read-in: R, x, R', b, a
                     # after transp.: R, x, R', a, b
 
-            block = [slice(3 * na, 3 * (na + 1)) for na in range(ph.nat)]
-
-            # undo supercell double counting:
+                    np.multiply(np.swapaxes(tmp, 2, 3), wk, out=g[irg])
 
-            if old_ws:
-                for irk in range(len(self.Rk)):
-                    g[:, :, irk] /= ndegen_k[irk]
-
-            elif ndegen_k.size == len(self.Rk):
-                for irk in range(len(self.Rk)):
-                    g[:, :, irk, :, :] /= ndegen_k[0, 0, irk]
-
-            else: # "use_ws"
-                for irk in range(len(self.Rk)):
-                    for m in range(el.size):
-                        for n in range(el.size):
-                            if ndegen_k[n, m, irk]:
-                                g[:, :, irk, m, n] /= ndegen_k[n, m, irk]
-                            else:
-                                g[:, :, irk, m, n] = 0.0
-
-            if old_ws:
-                for irg in range(len(self.Rg)):
-                    for na in range(ph.nat):
-                        if ndegen_g[na, irg]:
-                            g[irg, block[na]] /= ndegen_g[na, irg]
-                        else:
-                            g[irg, block[na]] = 0.0
-
-            elif ndegen_g.size == len(self.Rg):
-                for irg in range(len(self.Rg)):
-                    g[irg, :, :, :, :] /= ndegen_g[0, 0, 0, irg]
-
-            else: # "use_ws"
-                for irg in range(len(self.Rg)):
-                    for na in range(ph.nat):
-                        for m in range(el.size):
-                            for n in range(el.size):
-                                if ndegen_g[n, m, na, irg]:
-                                    g[irg, block[na], :, m, n] \
-                                        /= ndegen_g[n, m, na, irg]
-                                else:
-                                    g[irg, block[na], :, m, n] = 0.0
-
-            # divide by square root of atomic masses:
-
-            if divide_mass:
-                for na in range(ph.nat):
-                    g[:, block[na]] /= np.sqrt(ph.M[na])
+                    g[irg] *= wg[irg, :, np.newaxis]
 
         if node.rank == 0:
             images.Bcast(g)
@@ -247,20 +540,20 @@ class Model(object):
 
         self.data = g
 
-        self.q = None
-        self.gq = np.empty((ph.size, len(self.Rk), el.size, el.size),
-            dtype=complex)
-
     def sample(self, *args, **kwargs):
         """Sample coupling.
 
+        The coupling for all k points is obtained via :meth:`g_mesh`, such that
+        `symmetries` does not reduce the cost.
+
         See also
         --------
         sample
         """
         return sample(g=self.g, *args, **kwargs)
 
-def sample(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
+def sample(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False,
+        symmetries=None, storage=None):
     """Sample coupling for given q and k points and transform to band basis.
 
     One purpose of this routine is full control of the complex phase.
@@ -285,35 +578,136 @@ def sample(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
         Broadcast result from rank 0 to all processes?
     shared_memory : bool, optional
         Store transformed coupling in shared memory?
+    symmetries : iterable, optional
+        Symmetry operations of the crystal as yielded by
+        :func:`bravais.symmetries`, i.e., pairs of a description and a mapping
+        between the k-point indices of the original and the transformed mesh.
+        Since :func:`bravais.symmetries` compares scalars, it must be given a
+        single band, e.g., ``bravais.symmetries(e[:, :, 0], epsilon=1e-10)``
+        for the electron dispersion `e` on the k mesh, or a constant array,
+        e.g., ``bravais.symmetries(np.zeros((nk, nk)))``, which yields all
+        point-group operations of the lattice. Note that the symmetries of a
+        dispersion or the lattice are not necessarily symmetries of the
+        coupling; only operations of the crystal that leave the coupling
+        invariant must be passed. If present, the coupling is only evaluated
+        for the irreducible k points with respect to the little group of each q
+        point, i.e., the operations that leave q unchanged, and its squared
+        modulus :math:`|g|^2` is returned, which is invariant under these
+        operations in the band basis. This requires `U` and `u`. See Notes for
+        the case that `g` has a uniform-mesh counterpart.
+    storage : str, optional
+        Directory to which the transformed coupling is written q point by q
+        point instead of being gathered in memory. If present, an
+        :class:`MPI.DiskArray` is returned and `broadcast` and
+        `shared_memory` are ignored.
+
+    Notes
+    -----
+    If `g` has a uniform-mesh counterpart, e.g., :meth:`Model.g_mesh`, as found
+    by :func:`dispersion.meshed`, the coupling for all k points is obtained via
+    a single FFT per q point and transformed to the band basis at once. In this
+    case, `symmetries` does not reduce the cost, and only the squared modulus
+    :math:`|g|^2` is returned. This always applies to :meth:`Model.sample`,
+    which passes :meth:`Model.g`.
+
+    For degenerate electron or phonon states, only the sum of :math:`|g|^2`
+    over the degenerate subspace is symmetric. The individual contributions
+    obtained with `symmetries` then depend on the k point of the irreducible
+    wedge they have been copied from.
     """
-    sizes, bounds = MPI.distribute(len(q), bounds=True)
+    if symmetries is not None and (U is None or u is None):
+        MPI.info("Symmetrization requires band basis", error=True)
+
     col, row = MPI.matrix(len(q))
 
     nph, nel, nel = g().shape
 
+    dtype = complex if symmetries is None else float
+
+    if symmetries is not None:
+        symmetries = [image for name, image in symmetries]
+
     if U is not None:
         nel = U.shape[-1]
 
     if u is not None:
         nph = u.shape[-1]
 
-    my_g = np.empty((sizes[row.rank], nph, nk, nk, nel, nel), dtype=complex)
+    if storage is not None:
+        stored = MPI.DiskArray(storage, (len(q), nph, nk, nk, nel, nel),
+            dtype=dtype)
+
+    my_iq = []
+    my_g = []
 
-    status = misc.StatusBar(sizes[comm.rank] * nk * nk, title='sample coupling')
+    def store(iq, gq):
+        if storage is None:
+            my_iq.append(iq)
+            my_g.append(gq)
+        else:
+            stored[iq] = gq
+
+    mesh = dispersion.meshed(g)
+
+    status = misc.StatusBar(len(q), title='sample coupling')
 
     scale = 2 * np.pi / nk
 
-    for my_iq, iq in enumerate(range(*bounds[row.rank:row.rank + 2])):
+    # q points are handed out on demand to the first processes of the columns,
+    # the other processes of each column help with the Fourier transforms:
+
+    if col.rank == 0:
+        queue = MPI.dynamic(range(len(q)), comm=row)
+
+    done = 0
+
+    while True:
+        iq = next(queue, None) if col.rank == 0 else None
+        iq = col.bcast(iq)
+
+        while done < (len(q) if iq is None else iq):
+            status.update()
+            done += 1
+
+        if iq is None:
+            break
+
         q1, q2 = q[iq]
 
         Q1 = int(round(q1 / scale))
         Q2 = int(round(q2 / scale))
 
+        if mesh is not None:
+            gq = mesh(nk, q1=q1, q2=q2, broadcast=False, comm=col)
+
+            if col.rank == 0:
+                gq = band_basis(gq, Q1, Q2, U, None if u is None else u[iq])
+
+                if symmetries is not None:
+                    gq = abs(gq) ** 2
+
+                store(iq, gq)
+
+            continue
+
+        if col.rank == 0:
+            gq = np.empty((nph, nk, nk, nel, nel), dtype=dtype)
+
+        # little group of q (empty if symmetries are not used):
+
+        little = [image for image in symmetries or []
+            if tuple(image[Q1 % nk, Q2 % nk]) == (Q1 % nk, Q2 % nk)]
+
+        covered = np.zeros((nk, nk), dtype=bool)
+
         for K1 in range(nk):
             KQ1 = (K1 + Q1) % nk
             k1 = K1 * scale
 
             for K2 in range(nk):
+                if covered[K1, K2]:
+                    continue
+
                 KQ2 = (K2 + Q2) % nk
                 k2 = K2 * scale
 
@@ -327,15 +721,31 @@ def sample(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
                     if u is not None:
                         gqk = np.einsum('xab,xu->uab', gqk, u[iq])
 
-                    my_g[my_iq, :, K1, K2, :, :] = gqk
+                    if symmetries is not None:
+                        gqk = abs(gqk) ** 2
+
+                equivalent = {(K1, K2)}
+                equivalent.update(tuple(image[K1, K2]) for image in little)
+
+                for S1, S2 in equivalent:
+                    covered[S1, S2] = True
+
+                    if col.rank == 0:
+                        gq[:, S1, S2, :, :] = gqk
+
+        if col.rank == 0:
+            store(iq, gq)
 
-                status.update()
+    if storage is not None:
+        comm.Barrier()
+
+        return stored
 
     node, images, g = MPI.shared_array((len(q), nph, nk, nk, nel, nel),
-        dtype=complex, shared_memory=shared_memory, single_memory=not broadcast)
+        dtype=dtype, shared_memory=shared_memory, single_memory=not broadcast)
 
     if col.rank == 0:
-        row.Gatherv(my_g, (g, row.gather(my_g.size)))
+        MPI.collect(my_iq, my_g, g, broadcast=False, comm=row)
 
     col.Barrier() # should not be necessary
 
@@ -346,15 +756,17 @@ def sample(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
 
     return g
 
-def transform(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
+def transform(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False,
+        storage=None):
     """Transform q- and k-dependent coupling to band basis.
 
+    The coupling `g` may also be an :class:`MPI.DiskArray`, which is read q
+    point by q point.
+
     See Also
     --------
     sample
     """
-    sizes, bounds = MPI.distribute(len(q), bounds=True)
-
     nQ, nph, nk, nk, nel, nel = g.shape
 
     if U is not None:
@@ -363,35 +775,36 @@ def transform(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
     if u is not None:
         nph = u.shape[-1]
 
-    my_g = np.empty((sizes[comm.rank], nph, nk, nk, nel, nel), dtype=complex)
+    my_iq = []
+    my_g = []
 
     scale = 2 * np.pi / nk
 
-    for my_iq, iq in enumerate(range(*bounds[comm.rank:comm.rank + 2])):
+    if storage is not None:
+        stored = MPI.DiskArray(storage, (len(q), nph, nk, nk, nel, nel),
+            dtype=complex)
+
+    for iq in MPI.dynamic(range(len(q))):
         q1 = int(round(q[iq][0] / scale))
         q2 = int(round(q[iq][1] / scale))
 
-        for k1 in range(nk):
-            kq1 = (k1 + q1) % nk
-
-            for k2 in range(nk):
-                kq2 = (k2 + q2) % nk
+        gq = band_basis(g[iq], q1, q2, U, None if u is None else u[iq])
 
-                gqk = g[iq, :, k1, k2, :, :]
-
-                if U is not None:
-                    gqk = np.einsum('am,xab,bn->xmn',
-                        U[kq1, kq2].conj(), gqk, U[k1, k2])
+        if storage is None:
+            my_iq.append(iq)
+            my_g.append(gq)
+        else:
+            stored[iq] = gq
 
-                if u is not None:
-                    gqk = np.einsum('xab,xu->uab', gqk, u[iq])
+    if storage is not None:
+        comm.Barrier()
 
-                my_g[my_iq, :, k1, k2, :, :] = gqk
+        return stored
 
     node, images, g = MPI.shared_array((len(q), nph, nk, nk, nel, nel),
         dtype=complex, shared_memory=shared_memory, single_memory=not broadcast)
 
-    comm.Gatherv(my_g, (g, comm.gather(my_g.size)))
+    MPI.collect(my_iq, my_g, g, broadcast=False)
 
     if node.rank == 0:
         images.Bcast(g)
@@ -400,6 +813,44 @@ def transform(g, q, nk, U=None, u=None, broadcast=True, shared_memory=False):
 
     return g
 
+def band_basis(gq, q1, q2, U=None, u=None):
+    """Transform coupling for single q point and all k points to band basis.
+
+    Parameters
+    ----------
+    gq : ndarray
+        Coupling on uniform k mesh in the basis of electronic orbitals and
+        Cartesian ionic displacements, with shape ``(nph, nk, nk, nel, nel)``.
+    q1, q2 : int
+        q point in units of the k-mesh spacing.
+    U : ndarray, optional
+        Electron eigenvectors for given k mesh.
+        If present, transform from orbital to band basis.
+    u : ndarray, optional
+        Phonon eigenvectors for given q point.
+        If present, transform from displacement to band basis.
+
+    Returns
+    -------
+    ndarray
+        Transformed coupling.
+
+    Notes
+    -----
+    The eigenvectors at k + q are gathered once via the k + q index map and
+    all k points are transformed by a single batched matrix product, so that
+    no Python loop over k is required.
+    """
+    if U is not None:
+        Ukq = diagrams.shift(U, q1, q2)
+
+        gq = np.matmul(np.matmul(Ukq.conj().swapaxes(-2, -1), gq), U)
+
+    if u is not None:
+        gq = np.tensordot(u, gq, axes=(0, 0))
+
+    return gq
+
 def coupling(filename, nQ, nb, nk, bands, Q=None, nq=None, offset=0,
         completion=True, complete_k=False, squeeze=False, status=False,
         phase=False):
@@ -3,7 +3,9 @@
 # Copyright (C) 2021 elphmod Developers
 # This program is free software under the terms of the GNU GPLv3 or later.
 
+import hashlib
 import numpy as np
+import os
 import sys
 
 from . import MPI
@@ -66,3 +68,91 @@ def group(points, eps=1e-7):
                 groups[np.where(groups == groups[j])] = groups[i]
 
     return [np.where(groups == group)[0] for group in set(groups)]
+
+def checksum(filename, blocksize=2 ** 20):
+    """Calculate SHA-1 hash of file content.
+
+    Parameters
+    ----------
+    filename : str
+        Name of file.
+    blocksize : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    sha1 = hashlib.sha1()
+
+    with open(filename, 'rb') as data:
+        for block in iter(lambda: data.read(blocksize), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+def load_cache(source, cache=None):
+    """Load arrays from binary cache of text file, unless outdated.
+
+    The cache is considered valid if the SHA-1 hash of the source file agrees
+    with the stored value. Caches without stored hash are ignored.
+
+    Parameters
+    ----------
+    source : str
+        Name of original file.
+    cache : str
+        Name of cache file. Defaults to the name of `source` plus *.npz*.
+
+    Returns
+    -------
+    dict or None
+        Cached arrays, if available and up to date.
+
+    See Also
+    --------
+    save_cache
+    """
+    if cache is None:
+        cache = source + '.npz'
+
+    if not os.path.exists(cache):
+        return None
+
+    with np.load(cache) as data:
+        arrays = dict(data)
+
+    if 'checksum' not in arrays:
+        return None
+
+    if str(arrays.pop('checksum')) != checksum(source):
+        return None
+
+    return arrays
+
+def save_cache(source, arrays, cache=None):
+    """Save arrays parsed from text file to binary cache.
+
+    Parameters
+    ----------
+    source : str
+        Name of original file.
+    arrays : dict
+        Arrays to be saved.
+    cache : str
+        Name of cache file. Defaults to the name of `source` plus *.npz*.
+
+    See Also
+    --------
+    load_cache
+    """
+    if cache is None:
+        cache = source + '.npz'
+
+    try:
+        with open(cache, 'wb') as data:
+            np.savez(data, checksum=checksum(source), **arrays)
+
+    except (IOError, OSError):
+        pass # e.g., no write permission; just read text file next time
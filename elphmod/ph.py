@@ -6,7 +6,7 @@
 import os
 import numpy as np
 
-from . import bravais, MPI
+from . import bravais, misc, MPI
 comm = MPI.comm
 
 class Model(object):
@@ -26,6 +26,8 @@ class Model(object):
         Bravais lattice vectors if `flfrc` is omitted.
     tau : ndarray
         Positions of basis atoms if `flfrc` is omitted.
+    cache : bool
+        Cache parsed force constants in binary file? See :func:`read_flfrc`.
 
     Attributes
     ----------
@@ -47,11 +49,36 @@ class Model(object):
     def D(self, q1=0, q2=0, q3=0):
         "Set up dynamical matrix for arbitrary q point."""
 
-        q = np.array([q1, q2, q3])
-        D = np.empty(self.data.shape, dtype=complex)
+        return self.D_batch([[q1, q2, q3]])[0]
 
-        for n in range(D.shape[0]):
-            D[n] = self.data[n] * np.exp(-1j * np.dot(self.R[n], q))
+    def D_batch(self, q, chunk=1000):
+        r"""Set up dynamical matrices for many q points at once.
+
+        Parameters
+        ----------
+        q : ndarray
+            q points in crystal coordinates with period :math:`2 \pi`, one per
+            row. Missing trailing coordinates are treated as zero.
+        chunk : int
+            Maximum number of q points processed in one matrix product. This
+            limits the memory needed for the intermediate phase factors.
+
+        Returns
+        -------
+        ndarray
+            Dynamical matrices stacked along the first axis.
+        """
+        q = np.array(q, dtype=float, ndmin=2)
+
+        R = self.R[:, :q.shape[1]]
+        data = np.reshape(self.data, (len(self.R), -1))
+
+        D = np.empty((len(q), self.size, self.size), dtype=complex)
+
+        for lower in range(0, len(q), chunk):
+            upper = min(lower + chunk, len(q))
+
+            phase = np.exp(-1j * np.dot(q[lower:upper], R.T))
 
             # Sign convention in do_q3r.f90 of QE:
             # 231  CALL cfft3d ( phid (:,j1,j2,na1,na2), &
@@ -60,11 +87,37 @@ class Model(object):
             # 234       phid(:,j1,j2,na1,na2) / DBLE(nr1*nr2*nr3)
             # The last argument of cfft3d is the sign (+1).
 
-        return D.sum(axis=0)
+            D[lower:upper] = np.reshape(np.dot(phase, data),
+                (upper - lower, self.size, self.size))
+
+        return D
+
+    def D_mesh(self, nq1, nq2=None, nq3=None):
+        """Set up dynamical matrices on uniform q mesh via FFT.
+
+        Parameters
+        ----------
+        nq1, nq2, nq3 : int
+            Number of q points per dimension. `nq2` defaults to `nq1`. If `nq3`
+            is omitted, only the plane :math:`q_3 = 0` is considered and the
+            corresponding axis is dropped.
+
+        Returns
+        -------
+        ndarray
+            Dynamical matrices on mesh. ``D_mesh(nq)[Q1, Q2]`` equals
+            ``D(2 * np.pi * Q1 / nq, 2 * np.pi * Q2 / nq)``.
+        """
+        nq = (nq1, nq1 if nq2 is None else nq2)
+
+        if nq3 is not None:
+            nq += (nq3,)
+
+        return bravais.Fourier_mesh(self.R, self.data, nq, sign=-1)
 
     def __init__(self, flfrc=None, apply_asr=False,
         phid=np.zeros((1, 1, 1, 1, 1, 3, 3)), amass=np.ones(1),
-        at=np.eye(3), tau=np.zeros((1, 3))):
+        at=np.eye(3), tau=np.zeros((1, 3)), cache=False):
 
         if flfrc is None:
             if apply_asr:
@@ -74,7 +127,7 @@ class Model(object):
             model = phid, amass, at, tau
         else:
             if comm.rank == 0:
-                model = read_flfrc(flfrc)
+                model = read_flfrc(flfrc, cache)
 
                 # optionally, apply acoustic sum rule:
 
@@ -211,8 +264,34 @@ def write_q(fildyn0, q, nq):
         for qxy in q:
             data.write('%19.15f%19.15f%19.15f\n' % (qxy[0], qxy[1], 0.0))
 
-def read_flfrc(flfrc):
-    """Read file *flfrc* with force constants generated by ``q2r.x``."""
+def read_flfrc(flfrc, cache=False):
+    """Read file *flfrc* with force constants generated by ``q2r.x``.
+
+    Parameters
+    ----------
+    flfrc : str
+        File with interatomic force constants from ``q2r.x``.
+    cache : bool
+        Store parsed data in binary file *flfrc.npz* and read it from there as
+        long as `flfrc` is unchanged?
+
+    Returns
+    -------
+    list of ndarray
+        Force constants, atomic masses, Bravais lattice vectors, and positions
+        of basis atoms.
+
+    See Also
+    --------
+    misc.load_cache, misc.save_cache
+    """
+    keys = 'phid', 'amass', 'at', 'tau'
+
+    if cache:
+        cached = misc.load_cache(flfrc)
+
+        if cached is not None:
+            return [cached[key] for key in keys]
 
     with open(flfrc) as data:
         # read all words of current line:
@@ -289,23 +368,29 @@ def read_flfrc(flfrc):
 
         nr1, nr2, nr3 = map(int, cells())
 
-        phid = np.empty((nat, nat, nr1, nr2, nr3, 3, 3))
+        # each block consists of a line with j1, j2, na1, na2 followed by lines
+        # with m1, m2, m3, and the force constant, where m1 runs fastest:
+
+        block = 4 + 4 * nr1 * nr2 * nr3
 
-        for j1 in range(3):
-            for j2 in range(3):
-                for na1 in range(nat):
-                    for na2 in range(nat):
-                        cells() # skip line with j1, j2, na2, na2
+        # read all blocks into preallocated array (without intermediate
+        # strings):
 
-                        for m3 in range(nr3):
-                            for m2 in range(nr2):
-                                for m1 in range(nr1):
-                                    phid[na1, na2, m1, m2, m3, j1, j2] \
-                                        = float(cells()[-1])
+        ifc = np.fromfile(data, sep=' ', count=9 * nat * nat * block)
+
+    ifc = np.reshape(ifc, (3, 3, nat, nat, block))[..., 4:]
+    ifc = np.reshape(ifc, (3, 3, nat, nat, nr3, nr2, nr1, 4))[..., 3]
+
+    phid = np.transpose(ifc, (2, 3, 6, 5, 4, 0, 1)).copy()
 
     # return force constants, masses, and geometry:
 
-    return [phid, amass[ityp], at, tau]
+    model = [phid, amass[ityp], at, tau]
+
+    if cache:
+        misc.save_cache(flfrc, dict(zip(keys, model)))
+
+    return model
 
 def asr(phid):
     """Apply simple acoustic sum rule correction to force constants."""
@@ -326,82 +411,43 @@ def short_range_model(phid, amass, at, tau, eps=1e-7):
 
     nat, nr1, nr2, nr3 = phid.shape[1:5]
 
-    supercells = [-1, 0, 1] # indices of central and neighboring supercells
-
-    const = dict()
-
-    N = 0 # counter for parallelization
-
-    for m1 in range(nr1):
-        for m2 in range(nr2):
-            for m3 in range(nr3):
-                N += 1
-
-                if N % comm.size != comm.rank:
-                    continue
-
-                # determine equivalent unit cells within considered supercells:
-
-                copies = np.array([[
-                        m1 + M1 * nr1,
-                        m2 + M2 * nr2,
-                        m3 + M3 * nr3,
-                        ]
-                    for M1 in supercells
-                    for M2 in supercells
-                    for M3 in supercells
-                    ])
-
-                # calculate corresponding translation vectors:
-
-                shifts = [np.dot(copy, at) for copy in copies]
-
-                for na1 in range(nat):
-                    for na2 in range(nat):
-                        # find equivalent bond(s) within Wigner-Seitz cell:
-
-                        bonds = [r + tau[na1] - tau[na2] for r in shifts]
-                        lengths = [np.sqrt(np.dot(r, r)) for r in bonds]
-                        length = min(lengths)
-
-                        selected = copies[np.where(abs(lengths - length) < eps)]
+    # unit cells of force-constant mesh and their equivalents within central
+    # and neighboring supercells:
 
-                        # undo supercell double counting and divide by masses:
+    cells = np.reshape(np.indices((nr1, nr2, nr3)), (3, -1)).T
+    supercells = np.reshape(np.indices((3, 3, 3)), (3, -1)).T - 1
 
-                        C = phid[na1, na2, m1, m2, m3] / (
-                            len(selected) * np.sqrt(amass[na1] * amass[na2]))
+    copies = cells[:, None] + supercells[None] * np.array([nr1, nr2, nr3])
 
-                        # save data for dynamical matrix calculation:
+    # find equivalent bond(s) within Wigner-Seitz cell for all atom pairs:
 
-                        for R in selected:
-                            R = tuple(R)
+    bonds = (np.dot(copies, at)[:, :, None, None]
+        + tau[None, None, :, None] - tau[None, None, None, :])
 
-                            if R not in const:
-                                const[R] = np.zeros((3 * nat, 3 * nat))
+    lengths = np.sqrt(np.sum(bonds ** 2, axis=-1))
 
-                            const[R][3 * na1:3 * na1 + 3,
-                                     3 * na2:3 * na2 + 3] = C
+    selected = abs(lengths - lengths.min(axis=1, keepdims=True)) < eps
 
-    # convert dictionary into arrays:
+    # undo supercell double counting and divide by masses:
 
-    n = len(const)
+    C = np.reshape(np.transpose(phid, (2, 3, 4, 0, 1, 5, 6)),
+        (len(cells), nat, nat, 3, 3))
 
-    cells = np.array(list(const.keys()), dtype=np.int8)
-    const = np.array(list(const.values()))
+    C = C / (selected.sum(axis=1)
+        * np.sqrt(np.outer(amass, amass)))[:, :, :, None, None]
 
-    # gather data of all processes:
+    # collect data for dynamical matrix calculation:
 
-    dims = np.array(comm.allgather(n))
-    dim = dims.sum()
+    cell, copy, na1, na2 = np.nonzero(selected)
 
-    allcells = np.empty((dim, 3), dtype=np.int8)
-    allconst = np.empty((dim, 3 * nat, 3 * nat))
+    allcells, index = np.unique(copies[cell, copy], axis=0,
+        return_inverse=True)
 
-    comm.Allgatherv(cells[:n], (allcells, dims * 3))
-    comm.Allgatherv(const[:n], (allconst, dims * (3 * nat) ** 2))
+    allconst = np.zeros((len(allcells), nat, 3, nat, 3))
+    allconst[np.ravel(index), na1, :, na2, :] = C[cell, na1, na2]
 
-    # (see cdef _p_message message_vector in mpi4py/src/mpi4py/MPI/msgbuffer.pxi
-    # for possible formats of second argument 'recvbuf')
+    allcells = allcells.astype(int)
+    allconst = np.reshape(allconst, (len(allcells), 3 * nat, 3 * nat))
 
     return allcells, allconst
 